@@ -2,9 +2,16 @@ import os
 import random
 import re
 import sys
+from collections.abc import Mapping
+
+import numpy as np
 
 DAMPING = 0.85
 SAMPLES = 10000
+# iterate_pagerank stops once the ranks change by less than TOLERANCE in total
+# (L1 norm) in one iteration, or after MAX_ITERATIONS
+TOLERANCE = 1e-6
+MAX_ITERATIONS = 1000
 
 
 def main():
@@ -24,8 +31,9 @@ def main():
 def crawl(directory):
     """
     Parse a directory of HTML pages and check for links to other pages.
-    Return a dictionary where each key is a page, and values are
-    a list of all other pages in the corpus that are linked to by the page.
+    Return a LinkGraph, which works like a dictionary where each key is
+    a page, and values are a set of all other pages in the corpus that
+    are linked to by the page.
     """
     pages = dict()
 
@@ -38,11 +46,80 @@ def crawl(directory):
             links = re.findall(r"<a\s+(?:[^>]*?)href=\"([^\"]*)\"", contents)
             pages[filename] = set(links) - {filename}
 
-    # Only include links to other pages in the corpus
-    for filename in pages:
-        pages[filename] = set(link for link in pages[filename] if link in pages)
+    # LinkGraph only keeps links to other pages in the corpus
+    return LinkGraph(pages)
+
+
+class LinkGraph(Mapping):
+    """
+    A corpus with its links indexed in both directions.
+
+    Works like the corpus dictionary (page -> set of pages it links to,
+    links outside the corpus removed). Pages are also numbered in order
+    (`pages`, `index`), and the links are kept as NumPy arrays in CSR form:
+    the pages linked to by row i are out_indices[out_indptr[i]:out_indptr[i + 1]]
+    and the pages linking to it are in_indices[in_indptr[i]:in_indptr[i + 1]].
+    `out_degree` is the number of links on each page and `dangling` the rows
+    of the pages with no links. Build it once and pass it around instead of
+    the dictionary, so in-links are looked up in O(in-degree).
+    """
+
+    def __init__(self, corpus):
+        self.pages = list(corpus)
+        self.index = {page: i for i, page in enumerate(self.pages)}
+        n = len(self.pages)
+
+        # every link as a (source, target) pair of row numbers
+        n_links = np.fromiter((len(corpus[page]) for page in self.pages), dtype=np.int64, count=n)
+        targets = np.fromiter(
+            (self.index.get(link, -1) for page in self.pages for link in corpus[page]),
+            dtype=np.int64,
+            count=int(n_links.sum()),
+        )
+        sources = np.repeat(np.arange(n), n_links)
+        if (targets < 0).any():
+            # drop links to pages outside the corpus
+            in_corpus = targets >= 0
+            sources, targets = sources[in_corpus], targets[in_corpus]
+            self.links = {page: self.index.keys() & corpus[page] for page in self.pages}
+        else:
+            self.links = dict(corpus)
+
+        self.out_degree = np.bincount(sources, minlength=n)
+        self.out_indptr = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(self.out_degree, out=self.out_indptr[1:])
+        self.out_indices = targets
+
+        # the same links sorted by the page they point to
+        order = np.argsort(self.out_indices, kind="stable")
+        self.in_indices = sources[order]
+        self.in_degree = np.bincount(self.out_indices, minlength=n)
+        self.in_indptr = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(self.in_degree, out=self.in_indptr[1:])
+        self.dangling = np.flatnonzero(self.out_degree == 0)
+
+    def __getitem__(self, page):
+        return self.links[page]
+
+    def __iter__(self):
+        return iter(self.pages)
 
-    return pages
+    def __len__(self):
+        return len(self.pages)
+
+    def sources(self, page):
+        """
+        Return a list of the pages that link to `page`.
+        """
+        i = self.index[page]
+        return [self.pages[j] for j in self.in_indices[self.in_indptr[i]:self.in_indptr[i + 1]]]
+
+
+def as_graph(corpus):
+    """
+    Return `corpus` as a LinkGraph, building one only if it isn't already.
+    """
+    return corpus if isinstance(corpus, LinkGraph) else LinkGraph(corpus)
 
 
 def transition_model(corpus, page, damping_factor):
@@ -56,7 +133,7 @@ def transition_model(corpus, page, damping_factor):
     """
     probs = {}
 
-    if page not in corpus or corpus[page] is None:
+    if not corpus.get(page):
         # If no links, return uniform probability for all pages
         for key in corpus:
             probs[key] = 1 / len(corpus)
@@ -89,31 +166,25 @@ def sample_pagerank(corpus, damping_factor, n):
     their estimated PageRank value (a value between 0 and 1). All
     PageRank values should sum to 1.
     """
-    ranks = {}
-    counts = {}
-    c_page = random.choice(list(corpus.keys()))
-
-    if c_page not in counts.keys():
-        counts[c_page] = 1
-    else:
-        counts[c_page] += 1
-
-    for i in range(n - 1):
-        next_page_dict = transition_model(corpus, c_page, damping_factor)
-        pick = pick_by_prob(next_page_dict)
-
-        if pick not in counts.keys():
-            counts[pick] = 1
+    graph = as_graph(corpus)
+    size = len(graph)
+    out_indptr = graph.out_indptr.tolist()
+    out_indices = graph.out_indices.tolist()
+    counts = [0] * size
+    page = random.randrange(size)
+
+    # same choice as transition_model, without building the whole distribution:
+    # with probability damping_factor follow one of the page's links, otherwise
+    # (or if it has none) go to any page at random
+    for _ in range(n):
+        counts[page] += 1
+        start, stop = out_indptr[page], out_indptr[page + 1]
+        if start == stop or random.random() >= damping_factor:
+            page = random.randrange(size)
         else:
-            counts[pick] += 1
-
-        c_page = pick
-
-    for key, value in counts.items():
-        value = value / n
-        ranks[key] = value
+            page = out_indices[random.randrange(start, stop)]
 
-    return ranks
+    return {graph.pages[i]: count / n for i, count in enumerate(counts)}
 
 
 def iterate_pagerank(corpus, damping_factor):
@@ -125,72 +196,42 @@ def iterate_pagerank(corpus, damping_factor):
     their estimated PageRank value (a value between 0 and 1). All
     PageRank values should sum to 1.
     """
-    # with .15 prob the page was accessed randomly out of all pages
-    # .15 * 1/# of pages
-    # with 0.85 prob
-    ranks = {}
-    old_ranks = {}
-    page_rank = 1 / len(corpus)
-    for key in corpus:
-        ranks[f"{key}"] = page_rank
-
-    while True:
-        old_ranks = ranks.copy()
-        for key in ranks:
-            pr = (1 - damping_factor) / len(corpus)
-
-            # return list of all pages that have this page in them
-            sources = find_sources(corpus, key)
-            if len(sources) == 0:
-                for key in corpus:
-                    pr += damping_factor * (ranks[page] / len(corpus))
-            else:
-                source_ranks = 0
-
-                # Iterate through each source, and calculate their adder by
-                # dividing their current rank by the number of links they have.
-                # Then, add this to the sum (source ranks) and multiply by damping factor
-                for source in sources:
-                    if len(corpus[source]) != 0:
-                        source_ranks += ranks[source] / len(corpus[source])
-                    else:
-                        source_ranks += ranks[source] / len(corpus)
-
-                # add this second half of the equation to pr
-                pr += damping_factor * source_ranks
-
-            # update this key's value in rank
-            ranks[key] = pr
-
-        # figure out if its time to stop the loop yet
-        counter = 0
-        for key in ranks:
-            if abs(ranks[key] - old_ranks[key]) >= 0.001:
-                break
-            else:
-                counter += 1
-
-            if counter == len(corpus):
-                return ranks
-
-
-def pick_by_prob(dict):
-    n = random.random()
-    adder = 0
-    for key, value in dict.items():
-        spot = value + adder
-        if n < spot:
-            return key
-        else:
-            adder = spot
-
+    # The in-links of the graph are a sparse (CSR) matrix with a row per page;
+    # each link is weighted by 1 / the number of links on the linking page
+    graph = as_graph(corpus)
+    n = len(graph)
+    indices = graph.in_indices
+    weights = 1 / graph.out_degree[indices]
+    # row number of each link, so one bincount sums every row of the matrix times the ranks
+    rows = np.repeat(np.arange(n), graph.in_degree)
+    ranks = np.full(n, 1 / n)
+
+    for _ in range(MAX_ITERATIONS):
+        # with probability damping_factor follow a link (pages with no links spread
+        # their rank over every page), otherwise jump to any page at random
+        linked = np.bincount(rows, weights=weights * ranks[indices], minlength=n)
+        new_ranks = damping_factor * (linked + ranks[graph.dangling].sum() / n) + (1 - damping_factor) / n
+        change = np.abs(new_ranks - ranks).sum()
+        ranks = new_ranks
+        if change < TOLERANCE:
+            break
+
+    ranks /= ranks.sum()
+    return {page: float(rank) for page, rank in zip(graph.pages, ranks)}
+
+
+def find_sources(graph, page):
+    """
+    Return a list of the pages in `graph` that link to `page`.
+    Pages with no links are not included: they link to every page, and
+    are listed once in the graph's `dangling` instead.
 
-def find_sources(corpus, page):
-    sources = []
-    for key in corpus:
-        if page in corpus[key] or len(corpus[key]) == 0:
-            sources.append(key)
-    return sources
+    `graph` must be a LinkGraph: call as_graph once and pass the graph to
+    every lookup, since building one costs O(N + E).
+    """
+    if not isinstance(graph, LinkGraph):
+        raise TypeError("find_sources needs a LinkGraph; build one once with as_graph(corpus)")
+    return graph.sources(page)
 
 
 if __name__ == "__main__":
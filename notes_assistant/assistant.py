@@ -1,2 +1,112 @@
 # Goal is to create an chatbot that can answer questions about a set of notes and make flashcards/test questions
-import helpers as hp
\ No newline at end of file
+import helpers as hp
+
+MODEL = "gpt-4o-mini"
+EMBED_MODEL = "text-embedding-3-small"
+# Folder of txt/markdown notes, and where their embeddings are kept between runs
+NOTES_DIR = "notes"
+STORE_DIR = ".notes_store"
+INDEX_PATH = ".notes_store/bm25.sqlite"
+# Size, mtime and hash of every note already ingested, so only new and changed notes are processed at startup
+MANIFEST_PATH = ".notes_store/manifest.json"
+# Threads reading notes and sending embedding requests during ingestion
+INGEST_WORKERS = 4
+# Earlier answers are reused for questions at least this similar (cosine of the question embeddings)
+# and dropped after ANSWER_CACHE_TTL seconds or when the notes they came from change
+ANSWER_CACHE_PATH = ".notes_store/answers.sqlite"
+ANSWER_CACHE_THRESHOLD = 0.93
+ANSWER_CACHE_TTL = 7 * 24 * 3600
+# Notes are split into chunks of whole paragraphs of about this many characters
+CHUNK_CHARS = 2000
+# Number of note chunks given to the LLM with each question
+TOP_K = 5
+# Flashcards and test questions are appended to these files. Note sections are packed into requests of about
+# CARD_TOKEN_BUDGET tokens, CARD_WORKERS of which run at once; a topic uses its TOPIC_CHUNKS most relevant chunks
+CARDS_PATH = "flashcards.jsonl"
+QUIZ_PATH = "test_questions.jsonl"
+CARD_TOKEN_BUDGET = 6000
+CARD_WORKERS = 4
+TOPIC_CHUNKS = 20
+
+sys_prompt = "You are a helpful study assistant. You answer questions using only the student's notes and say so when the notes don't cover something."
+answer_prompt = "Answer the question below using the note excerpts after the '---'. Cite the note file names you used in brackets. If the excerpts don't contain the answer, say that the notes don't cover it."
+card_format = ('Write one JSON object per line and nothing else, like {"front": ..., "back": ..., "source": ...}, '
+               "where source is the note file name in brackets above the section the card comes from.")
+card_prompt = ("Make flashcards from the note sections after the '---'. Each card tests one fact, term or idea: "
+               "the front is a short question or term and the back is the answer. Skip trivial details. " + card_format)
+quiz_prompt = ("Write test questions from the note sections after the '---', like an exam on the material would. "
+               "Mix recall and application questions: the front is the question and the back is a model answer. " + card_format)
+
+
+def retrieve(store, index, question, question_vector, k=TOP_K):
+    # The k note chunks for the question: the ones closest in meaning (embeddings) and the ones
+    # sharing its rarest words (BM25) are merged, so exact terms and paraphrases both get found
+    by_meaning = store.search(question_vector, k)[0]
+    by_words = index.search(question, k)
+    chunks = {hp.chunk_key(meta): meta for _, meta in by_meaning}
+    chunks.update((key, meta) for _, key, meta in by_words)
+    ranked = hp.fuse([[hp.chunk_key(meta) for _, meta in by_meaning], [key for _, key, _ in by_words]], k)
+    return [chunks[key] for key in ranked]
+
+
+def answer(client, store, index, cache, question):
+    # Has the LLM answer the question from the most relevant note chunks, unless the same
+    # question (or one close enough in meaning) was answered before
+    cached = cache.get(question)
+    if cached is not None:
+        return cached
+    question_vector = hp.embed(client, [question], EMBED_MODEL)
+    cached = cache.get(question, question_vector[0])
+    if cached is not None:
+        return cached
+
+    chunks = retrieve(store, index, question, question_vector)
+    excerpts = "\n\n---\n\n".join(f"[{meta['source']}]\n{meta['text']}" for meta in chunks)
+    text = hp.ask(client, MODEL, sys_prompt, answer_prompt, f"Question: {question}\n\n---\n{excerpts}")
+    cache.put(question, question_vector[0], text, {meta["source"] for meta in chunks})
+    return text
+
+
+def make_cards(client, store, index, command, topic):
+    # Writes flashcards ('/cards') or test questions ('/quiz') for the chunks most relevant to the topic,
+    # or for all the notes without one
+    if topic:
+        chunks = retrieve(store, index, topic, hp.embed(client, [topic], EMBED_MODEL), TOPIC_CHUNKS)
+    else:
+        chunks = store.metas(store.live_rows())
+    # In note order, so the sections packed into one request are usually from the same note
+    sections = sorted(chunks, key=lambda meta: (meta["source"], meta["chunk"]))
+    kind, prompt, path = ("test question", quiz_prompt, QUIZ_PATH) if command == "/quiz" else ("flashcard", card_prompt, CARDS_PATH)
+    stats = hp.generate_cards(client, MODEL, sys_prompt, prompt, sections, path, CARD_TOKEN_BUDGET, CARD_WORKERS, kind)
+    failed = f", {stats['failed']} requests failed" if stats["failed"] else ""
+    return (f"{stats['cards']} {kind}s written to {path} from {len(sections)} note chunks in {stats['requests']} requests "
+            f"({stats['duplicates']} duplicates dropped{failed})")
+
+
+def main():
+    client = hp.get_client()
+    store = hp.VectorStore(STORE_DIR)
+    index = hp.BM25Index(INDEX_PATH)
+    manifest, stats = hp.ingest_notes(client, NOTES_DIR, store, index, MANIFEST_PATH, EMBED_MODEL, CHUNK_CHARS, INGEST_WORKERS)
+    print(f"{len(store)} note chunks loaded ({stats['added']} notes added, {stats['changed']} changed, "
+          f"{stats['removed']} removed, {stats['unchanged']} unchanged)")
+    cache = hp.AnswerCache(ANSWER_CACHE_PATH, ANSWER_CACHE_THRESHOLD, ttl=ANSWER_CACHE_TTL)
+    cache.sync_notes({path: entry["sha256"] for path, entry in manifest.items()})
+
+    while True:
+        question = input("Ask a question about your notes, or /cards or /quiz [topic] (blank to quit): ").strip()
+        if not question:
+            break
+        command, _, topic = question.partition(" ")
+        if command in ("/cards", "/quiz"):
+            print(make_cards(client, store, index, command, topic.strip()))
+        else:
+            print(answer(client, store, index, cache, question))
+        print()
+    store.close()
+    index.close()
+    cache.close()
+
+
+if __name__ == "__main__":
+    main()
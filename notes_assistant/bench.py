@@ -0,0 +1,59 @@
+## Query latency benchmark for the BM25 note index at different corpus sizes, on made-up notes so it needs no API key
+import argparse
+import itertools
+import os
+import random
+import statistics
+import tempfile
+import time
+
+import helpers as hp
+
+# Zipf-like vocabulary: a few very common words and a long tail of rare ones, like real notes
+VOCAB = [f"w{i}" for i in range(20000)]
+CUM_WEIGHTS = list(itertools.accumulate(1 / (i + 1) for i in range(len(VOCAB))))
+
+
+def make_notes(n_docs, words_per_doc, seed=0):
+    rng = random.Random(seed)
+    for i in range(n_docs):
+        yield f"note{i}", " ".join(rng.choices(VOCAB, cum_weights=CUM_WEIGHTS, k=words_per_doc)), {"note": i}
+
+
+def make_queries(n_queries, words_per_query, seed=1):
+    rng = random.Random(seed)
+    return [" ".join(rng.choices(VOCAB, cum_weights=CUM_WEIGHTS, k=words_per_query)) for _ in range(n_queries)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark BM25 query latency against corpus size")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 50000], help="number of notes")
+    parser.add_argument("--words", type=int, default=150, help="words per note")
+    parser.add_argument("--queries", type=int, default=200, help="queries timed per size")
+    parser.add_argument("--query-words", type=int, default=4, help="words per query")
+    parser.add_argument("--k", type=int, default=5, help="results per query")
+    args = parser.parse_args()
+
+    queries = make_queries(args.queries, args.query_words)
+    print(f"{'notes':>8} {'build s':>8} {'p50 ms':>8} {'p95 ms':>8} {'max ms':>8} {'index MB':>9}")
+    with tempfile.TemporaryDirectory() as folder:
+        for size in args.sizes:
+            path = os.path.join(folder, f"bm25_{size}.sqlite")
+            index = hp.BM25Index(path)
+            start = time.perf_counter()
+            index.add_many(make_notes(size, args.words))
+            build = time.perf_counter() - start
+
+            times = []
+            for q in queries:
+                start = time.perf_counter()
+                index.search(q, args.k)
+                times.append((time.perf_counter() - start) * 1000)
+            times.sort()
+            index.close()
+            print(f"{size:>8} {build:>8.2f} {statistics.median(times):>8.3f} {times[int(len(times) * 0.95)]:>8.3f} "
+                  f"{times[-1]:>8.3f} {os.path.getsize(path) / 1e6:>9.1f}")
+
+
+if __name__ == "__main__":
+    main()
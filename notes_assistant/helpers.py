@@ -0,0 +1,914 @@
+## Helper functions for the notes assistant: reading and splitting notes, LLM/embedding requests, the vector store,
+## keyword index, answer cache, incremental ingestion and flashcard generation
+import hashlib
+import heapq
+import json
+import math
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache
+
+import numpy as np
+
+
+@lru_cache(maxsize=None)
+def get_client():
+    # The OpenAI client is built the first time it is needed and then reused for every request
+    from dotenv import load_dotenv
+    from openai import OpenAI
+    load_dotenv()
+    return OpenAI(api_key=os.getenv("OPEN_AI_KEY"))
+
+
+def find_notes(folder):
+    # Every txt and markdown file under 'folder', in a stable order
+    notes = []
+    for root, _, files in os.walk(folder):
+        for name in files:
+            if name.endswith(".txt") or name.endswith(".md"):
+                notes.append(os.path.join(root, name))
+    return sorted(notes)
+
+
+def read_note(path):
+    with open(path, "r", encoding="utf-8", errors="replace") as f:
+        return f.read()
+
+
+def split_note(text, max_chars=2000):
+    # Splits a note into chunks of whole paragraphs of up to about 'max_chars' characters.
+    # A paragraph longer than that is cut between sentences
+    pieces = []
+    for para in re.split(r"\n\s*\n", text):
+        para = para.strip()
+        while len(para) > max_chars:
+            cut = para.rfind(". ", 0, max_chars)
+            cut = cut + 1 if cut > 0 else max_chars
+            pieces.append(para[:cut].strip())
+            para = para[cut:].strip()
+        if para:
+            pieces.append(para)
+
+    chunks = []
+    current = ""
+    for piece in pieces:
+        if current and len(current) + len(piece) + 2 > max_chars:
+            chunks.append(current)
+            current = ""
+        current = f"{current}\n\n{piece}" if current else piece
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def chunk_key(meta):
+    # Key of a note chunk in the keyword index
+    return f"{meta['source']}#{meta['chunk']}"
+
+
+def embed(client, texts, model, batch_size=256):
+    # Embeds 'texts' with one request per 'batch_size' texts and returns a float32 array with one row per text
+    rows = []
+    for i in range(0, len(texts), batch_size):
+        resp = client.embeddings.create(model=model, input=texts[i:i + batch_size])
+        rows.extend(d.embedding for d in resp.data)
+    if not rows:
+        return np.empty((0, 0), dtype=np.float32)
+    return np.asarray(rows, dtype=np.float32)
+
+
+def ask(client, model, sys_prompt, prompt, text, max_output_tokens=800):
+    # Sends one system + user request and returns the answer text
+    resp = client.responses.create(
+        model=model,
+        input=[
+            {"role": "system", "content": [{"type": "input_text", "text": sys_prompt}]},
+            {"role": "user", "content": [{"type": "input_text", "text": f"{prompt}\n\n---\n{text}"}]},
+        ],
+        max_output_tokens=max_output_tokens,
+    )
+    return resp.output_text
+
+
+def normalize(vectors):
+    # Scales each row to length 1 so the dot product of two rows is their cosine similarity
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def read_jsonl(path):
+    # Entries of a JSONL file. A half-written last line (from a crash while appending) is cut off
+    # the file so lines appended later start clean
+    entries = []
+    if not os.path.exists(path):
+        return entries
+    with open(path, "rb+") as f:
+        good = 0
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                break
+            if not line.endswith(b"\n"):
+                break
+            entries.append(entry)
+            good += len(line)
+        f.truncate(good)
+    return entries
+
+
+class VectorStore:
+    """
+    Embeddings of note chunks in a memory-mapped float32 `.npy` file, with
+    the metadata of each row (source file, chunk text, ...) in a JSONL
+    sidecar. Only a small row index (source, chunk number and where the
+    row's line is in the sidecar) is loaded when the store opens; a row's
+    full metadata is read from the sidecar when it is returned.
+
+    Vectors are normalized when added, so cosine similarity is a dot
+    product. The `.npy` file is allocated with spare rows and doubled when it
+    fills up, so `add` only writes the new rows and appends their metadata,
+    and opening the store maps the file instead of reading it. The sidecar
+    index decides how many rows are in use, so rows written by an `add` that
+    crashed before their metadata and index lines were saved are ignored.
+
+    Deleted rows are listed in a third file and skipped by `search`. Once
+    half the rows are deleted, the live rows are copied into a new
+    generation of files, which replaces the old one by rewriting the one-line
+    `CURRENT` file, so a crash while compacting leaves the old files in use.
+    """
+
+    def __init__(self, path, initial_rows=1024):
+        self.path = path
+        self.initial_rows = initial_rows
+        self._lock = threading.Lock()
+        self._read_lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+        self._current_path = os.path.join(path, "CURRENT")
+        gen = 0
+        if os.path.exists(self._current_path):
+            with open(self._current_path) as f:
+                gen = int(f.read())
+        self._open(gen)
+
+    def _files(self, gen):
+        suffix = f".{gen}" if gen else ""
+        return (os.path.join(self.path, f"vectors{suffix}.npy"), os.path.join(self.path, f"meta{suffix}.jsonl"),
+                os.path.join(self.path, f"deleted{suffix}.jsonl"), os.path.join(self.path, f"rows{suffix}.jsonl"))
+
+    def _open(self, gen):
+        self._gen = gen
+        self._vectors_path, self._meta_path, self._deleted_path, self._rows_path = self._files(gen)
+        # Files of other generations are left over from a compaction that crashed or was just finished
+        current = {os.path.basename(f) for f in self._files(gen)} | {"CURRENT"}
+        for name in os.listdir(self.path):
+            if re.fullmatch(r"(vectors(\.\d+)?\.npy|(meta|deleted|rows)(\.\d+)?\.jsonl)(\.tmp)?", name) and name not in current:
+                os.remove(os.path.join(self.path, name))
+
+        if os.path.exists(self._meta_path) and not os.path.exists(self._rows_path):
+            self._index_sidecar()
+        # [source, chunk, offset, length] of each row, the last two locating its line in the sidecar
+        self.rows = [tuple(row) for row in read_jsonl(self._rows_path)]
+        self.deleted = set(read_jsonl(self._deleted_path))
+        self._meta_file = open(self._meta_path, "ab")
+        self._rows_file = open(self._rows_path, "a", encoding="utf-8")
+        self._deleted_file = open(self._deleted_path, "a", encoding="utf-8")
+        self._reader = open(self._meta_path, "rb")
+
+        self._vectors = None
+        self.dim = None
+        if os.path.exists(self._vectors_path):
+            self._vectors = np.load(self._vectors_path, mmap_mode="r+")
+            self.dim = self._vectors.shape[1]
+
+    def _index_sidecar(self):
+        # Builds the row index of a store written before there was one, by reading the sidecar once
+        metas = read_jsonl(self._meta_path)
+        offset = 0
+        with open(self._meta_path, "rb") as f, open(self._rows_path + ".tmp", "w", encoding="utf-8") as out:
+            for meta, line in zip(metas, f):
+                out.write(json.dumps([meta.get("source"), meta.get("chunk"), offset, len(line)]) + "\n")
+                offset += len(line)
+        os.replace(self._rows_path + ".tmp", self._rows_path)
+
+    def __len__(self):
+        return len(self.rows) - len(self.deleted)
+
+    def _read(self, reader, rows, row_numbers):
+        # Full metadata of the given rows, read from the sidecar in file order
+        metas = {}
+        with self._read_lock:
+            for row in sorted(set(row_numbers), key=lambda r: rows[r][2]):
+                _, _, offset, length = rows[row]
+                reader.seek(offset)
+                metas[row] = json.loads(reader.read(length))
+        return [metas[row] for row in row_numbers]
+
+    def metas(self, row_numbers):
+        # Full metadata (with the chunk text) of the given rows
+        with self._lock:
+            reader, rows = self._reader, self.rows
+        return self._read(reader, rows, row_numbers)
+
+    def live_rows(self):
+        return [row for row in range(len(self.rows)) if row not in self.deleted]
+
+    def rows_where(self, field, values):
+        # Live rows whose 'field' ("source" or "chunk") is one of 'values'
+        position = {"source": 0, "chunk": 1}[field]
+        values = set(values)
+        return [row for row in self.live_rows() if self.rows[row][position] in values]
+
+    def _reserve(self, rows, dim):
+        # Makes sure the file has room for 'rows' rows, doubling its size when it doesn't
+        if self._vectors is None:
+            self.dim = dim
+            self._vectors = np.lib.format.open_memmap(self._vectors_path, mode="w+", dtype=np.float32,
+                                                      shape=(max(rows, self.initial_rows), dim))
+            return
+        if dim != self.dim:
+            raise ValueError(f"Vectors have {dim} dimensions but the store has {self.dim}")
+        capacity = len(self._vectors)
+        if rows <= capacity:
+            return
+
+        # Copy into a bigger file next to this one, then swap it in, so a crash leaves the old file whole
+        tmp_path = self._vectors_path + ".tmp"
+        grown = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=np.float32, shape=(max(rows, capacity * 2), dim))
+        used = len(self.rows)
+        for start in range(0, used, 1 << 16):
+            grown[start:min(start + (1 << 16), used)] = self._vectors[start:min(start + (1 << 16), used)]
+        grown.flush()
+        del grown
+        os.replace(tmp_path, self._vectors_path)
+        self._vectors = np.load(self._vectors_path, mmap_mode="r+")
+
+    def add(self, vectors, metas):
+        # Appends one row per vector, with the matching entry of 'metas' (a json-serializable dict)
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if len(vectors) != len(metas):
+            raise ValueError(f"Got {len(vectors)} vectors but {len(metas)} metadata entries")
+        if len(vectors) == 0:
+            return
+        vectors = normalize(vectors)
+        with self._lock:
+            start = len(self.rows)
+            self._reserve(start + len(vectors), vectors.shape[1])
+            # Vectors go to disk before their metadata, and the metadata before the row index, so a
+            # row is only counted once its vector and metadata are saved
+            self._vectors[start:start + len(vectors)] = vectors
+            self._vectors.flush()
+            rows = []
+            offset = self._meta_file.tell()
+            for m in metas:
+                line = (json.dumps(m) + "\n").encode("utf-8")
+                self._meta_file.write(line)
+                rows.append((m.get("source"), m.get("chunk"), offset, len(line)))
+                offset += len(line)
+            self._meta_file.flush()
+            for row in rows:
+                self._rows_file.write(json.dumps(row) + "\n")
+            self._rows_file.flush()
+            self.rows.extend(rows)
+
+    def delete(self, rows):
+        # Deletes rows by index (positions in self.rows). Indexes of the remaining rows
+        # change when the store is compacted, so look them up again after a delete
+        with self._lock:
+            rows = [row for row in rows if row not in self.deleted and 0 <= row < len(self.rows)]
+            for row in rows:
+                self._deleted_file.write(json.dumps(row) + "\n")
+            self._deleted_file.flush()
+            self.deleted.update(rows)
+            if len(self.deleted) * 2 > len(self.rows):
+                self._compact()
+
+    def delete_where(self, field, values):
+        # Deletes every row whose 'field' ("source" or "chunk") is one of 'values' (e.g. all chunks of some source files)
+        self.delete(self.rows_where(field, values))
+
+    def _compact(self):
+        # Copies the live rows into the next generation of files and switches over to it
+        live = self.live_rows()
+        vectors_path, meta_path, _, rows_path = self._files(self._gen + 1)
+        if self._vectors is not None:
+            packed = np.lib.format.open_memmap(vectors_path, mode="w+", dtype=np.float32,
+                                               shape=(max(len(live), self.initial_rows), self.dim))
+            for start in range(0, len(live), 1 << 16):
+                rows = live[start:start + (1 << 16)]
+                packed[start:start + len(rows)] = self._vectors[rows]
+            packed.flush()
+            del packed
+        # Metadata lines are copied as they are, without parsing them
+        offset = 0
+        with open(meta_path, "wb") as f, open(rows_path, "w", encoding="utf-8") as index:
+            for row in live:
+                source, chunk, old_offset, length = self.rows[row]
+                self._reader.seek(old_offset)
+                f.write(self._reader.read(length))
+                index.write(json.dumps([source, chunk, offset, length]) + "\n")
+                offset += length
+
+        with open(self._current_path + ".tmp", "w") as f:
+            f.write(str(self._gen + 1))
+        os.replace(self._current_path + ".tmp", self._current_path)
+        self._meta_file.close()
+        self._rows_file.close()
+        self._deleted_file.close()
+        # The old reader isn't closed: searches that started before the switch may still use it, and
+        # it is closed once they drop it
+        self._vectors = None
+        self._open(self._gen + 1)
+
+    def search(self, queries, k=5, block_rows=1 << 16):
+        # Top 'k' rows by cosine similarity for each query (one per row of 'queries'), as lists of
+        # (score, metadata) pairs, best first. Rows are scored 'block_rows' at a time with one matrix
+        # product for all queries, so only one block of the file needs to be in memory at once
+        queries = normalize(np.atleast_2d(np.asarray(queries, dtype=np.float32)))
+        with self._lock:
+            vectors, index, reader, used = self._vectors, self.rows, self._reader, len(self.rows)
+            deleted = np.array(sorted(self.deleted), dtype=np.int64)
+        k = min(k, used - len(deleted))
+        if k <= 0:
+            return [[] for _ in queries]
+
+        best_scores = np.empty((len(queries), 0), dtype=np.float32)
+        best_rows = np.empty((len(queries), 0), dtype=np.int64)
+        for start in range(0, used, block_rows):
+            block = vectors[start:min(start + block_rows, used)]
+            block_scores = queries @ block.T
+            # Deleted rows can't win
+            dead = deleted[(deleted >= start) & (deleted < start + len(block))] - start
+            block_scores[:, dead] = -np.inf
+            scores = np.concatenate([best_scores, block_scores], axis=1)
+            rows = np.concatenate([best_rows, np.broadcast_to(np.arange(start, start + len(block)),
+                                                              (len(queries), len(block)))], axis=1)
+            # Keep only the k best seen so far for each query
+            if scores.shape[1] > k:
+                top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+                scores = np.take_along_axis(scores, top, axis=1)
+                rows = np.take_along_axis(rows, top, axis=1)
+            best_scores, best_rows = scores, rows
+
+        order = np.argsort(-best_scores, axis=1)
+        hits = [[(float(best_scores[q, j]), int(best_rows[q, j])) for j in order[q] if best_scores[q, j] > -np.inf]
+                for q in range(len(queries))]
+        found = [row for hit in hits for _, row in hit]
+        metas = dict(zip(found, self._read(reader, index, found)))
+        return [[(score, metas[row]) for score, row in hit] for hit in hits]
+
+    def close(self):
+        with self._lock:
+            self._meta_file.close()
+            self._rows_file.close()
+            self._deleted_file.close()
+            self._reader.close()
+            if self._vectors is not None:
+                self._vectors.flush()
+
+
+# Words too common to say anything about which note a question is about
+STOPWORDS = frozenset(
+    "a an and are as at be by for from has have how in is it its of on or that the this to was were what when "
+    "where which who why will with".split()
+)
+
+
+def terms(text):
+    # Lowercased words of the text, without stopwords
+    return [w for w in re.findall(r"\w+", text.lower()) if w not in STOPWORDS]
+
+
+class BM25Index:
+    """
+    On-disk inverted index over note chunks with BM25 ranking, in a single
+    SQLite file.
+
+    Each term's postings (document ids and term frequencies) are stored as
+    packed arrays, one row per term per batch of added documents, so a query
+    reads only a few rows for each of its terms and scores them with NumPy.
+    Deleted documents are dropped from the `docs` table right away and their
+    postings are skipped at query time; once there are more than
+    `max_segments` batches, or a quarter of the postings belong to deleted
+    documents, the postings are merged and cleaned up. Document lengths are
+    kept in memory, and metadata is only read for the top `k` results.
+    Documents are identified by a caller-chosen key; adding a key that is
+    already indexed replaces that document.
+    """
+
+    def __init__(self, path, k1=1.5, b=0.75, max_segments=16):
+        self.path = path
+        self.k1 = k1
+        self.b = b
+        self.max_segments = max_segments
+
+        # One connection shared by threads, guarded by a lock
+        self._lock = threading.Lock()
+        folder = os.path.dirname(path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        # AUTOINCREMENT so the id of a deleted document is never reused while old postings may still point at it.
+        # 'terms' is the number of distinct terms, i.e. how many postings the document has
+        self._db.execute("CREATE TABLE IF NOT EXISTS docs (id INTEGER PRIMARY KEY AUTOINCREMENT, key TEXT UNIQUE NOT NULL, "
+                         "length INTEGER NOT NULL, terms INTEGER NOT NULL, meta TEXT NOT NULL)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS postings (term TEXT NOT NULL, segment INTEGER NOT NULL, "
+                         "docs BLOB NOT NULL, tfs BLOB NOT NULL, PRIMARY KEY (term, segment)) WITHOUT ROWID")
+        self._db.commit()
+
+        rows = self._db.execute("SELECT id, key, length FROM docs").fetchall()
+        self._keys = {key: doc for doc, key, _ in rows}
+        # Length of every live document by id (0 for deleted ids, which never have postings)
+        self._lengths = np.zeros(max(max((doc for doc, _, _ in rows), default=0) + 1, 1024), dtype=np.float32)
+        for doc, _, length in rows:
+            self._lengths[doc] = length
+        self._total_length = sum(length for _, _, length in rows)
+        # BM25 length normalization of every document, worked out again after each change
+        self._norms = None
+
+        segments, last, postings = self._db.execute(
+            "SELECT COUNT(DISTINCT segment), COALESCE(MAX(segment), -1), COALESCE(SUM(LENGTH(docs)), 0) / 4 FROM postings"
+        ).fetchone()
+        self._segments = segments
+        self._next_segment = last + 1
+        self._postings = postings
+        self._dead_postings = postings - self._db.execute("SELECT COALESCE(SUM(terms), 0) FROM docs").fetchone()[0]
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, key):
+        return key in self._keys
+
+    def _delete(self, key):
+        doc = self._keys.pop(key, None)
+        if doc is None:
+            return
+        n_terms = self._db.execute("SELECT terms FROM docs WHERE id = ?", (doc,)).fetchone()[0]
+        self._db.execute("DELETE FROM docs WHERE id = ?", (doc,))
+        self._total_length -= int(self._lengths[doc])
+        self._lengths[doc] = 0
+        self._dead_postings += n_terms
+        self._norms = None
+
+    def add_many(self, items):
+        # Adds (key, text, meta) items in one transaction, as one new segment of postings
+        with self._lock:
+            new = {}
+            for key, text, meta in items:
+                self._delete(key)
+                counts = Counter(terms(text))
+                length = sum(counts.values())
+                doc = self._db.execute("INSERT INTO docs (key, length, terms, meta) VALUES (?, ?, ?, ?)",
+                                       (key, length, len(counts), json.dumps(meta))).lastrowid
+                if doc >= len(self._lengths):
+                    self._lengths = np.concatenate([self._lengths, np.zeros(doc + 1, dtype=np.float32)])
+                self._keys[key] = doc
+                self._lengths[doc] = length
+                self._total_length += length
+                for term, tf in counts.items():
+                    docs, tfs = new.setdefault(term, ([], []))
+                    docs.append(doc)
+                    tfs.append(tf)
+            self._norms = None
+
+            if new:
+                self._db.executemany("INSERT INTO postings (term, segment, docs, tfs) VALUES (?, ?, ?, ?)",
+                                     ((term, self._next_segment, np.asarray(docs, dtype=np.int32).tobytes(),
+                                       np.asarray(tfs, dtype=np.int32).tobytes()) for term, (docs, tfs) in new.items()))
+                self._next_segment += 1
+                self._segments += 1
+                self._postings += sum(len(docs) for docs, _ in new.values())
+            self._maybe_compact()
+            self._db.commit()
+
+    def add(self, key, text, meta=None):
+        self.add_many([(key, text, meta)])
+
+    def delete_many(self, keys):
+        with self._lock:
+            for key in keys:
+                self._delete(key)
+            self._maybe_compact()
+            self._db.commit()
+
+    def delete(self, key):
+        self.delete_many([key])
+
+    def _maybe_compact(self):
+        if self._segments > self.max_segments or self._dead_postings * 4 > self._postings:
+            self._compact()
+
+    def _compact(self):
+        # Rewrites the postings with one segment per term and without deleted documents
+        self._db.execute("DROP TABLE IF EXISTS postings_new")
+        self._db.execute("CREATE TABLE postings_new (term TEXT NOT NULL, segment INTEGER NOT NULL, "
+                         "docs BLOB NOT NULL, tfs BLOB NOT NULL, PRIMARY KEY (term, segment)) WITHOUT ROWID")
+        rows = self._db.execute("SELECT term, docs, tfs FROM postings ORDER BY term, segment").fetchall()
+        merged = []
+        term, docs, tfs = None, [], []
+        # The sentinel row at the end flushes the last term
+        for row_term, row_docs, row_tfs in rows + [(None, b"", b"")]:
+            if row_term != term and docs:
+                docs, tfs = np.concatenate(docs), np.concatenate(tfs)
+                live = self._lengths[docs] > 0
+                if live.any():
+                    merged.append((term, 0, docs[live].tobytes(), tfs[live].tobytes()))
+                docs, tfs = [], []
+            term = row_term
+            docs.append(np.frombuffer(row_docs, dtype=np.int32))
+            tfs.append(np.frombuffer(row_tfs, dtype=np.int32))
+        self._db.executemany("INSERT INTO postings_new VALUES (?, ?, ?, ?)", merged)
+        self._db.execute("DROP TABLE postings")
+        self._db.execute("ALTER TABLE postings_new RENAME TO postings")
+        self._segments = 1 if merged else 0
+        self._next_segment = 1
+        self._postings -= self._dead_postings
+        self._dead_postings = 0
+
+    def search(self, query, k=5):
+        # The 'k' best documents for the query by BM25 score, as (score, key, meta) tuples, best first
+        query_terms = sorted(set(terms(query)))
+        with self._lock:
+            n = len(self._keys)
+            if not query_terms or n == 0:
+                return []
+            if self._norms is None:
+                # Deleted documents get an infinite norm, so their stale postings score 0
+                avg_length = self._total_length / n
+                self._norms = np.where(self._lengths > 0,
+                                       self.k1 * (1 - self.b + self.b * self._lengths / max(avg_length, 1e-9)), np.inf)
+            norms = self._norms
+            has_dead = self._dead_postings > 0
+            marks = ",".join("?" * len(query_terms))
+            rows = self._db.execute(f"SELECT term, docs, tfs FROM postings WHERE term IN ({marks}) ORDER BY term",
+                                    query_terms).fetchall()
+
+            by_term = {}
+            for term, docs, tfs in rows:
+                by_term.setdefault(term, []).append((np.frombuffer(docs, dtype=np.int32), np.frombuffer(tfs, dtype=np.int32)))
+            all_docs, all_scores = [], []
+            for parts in by_term.values():
+                docs = np.concatenate([d for d, _ in parts]) if len(parts) > 1 else parts[0][0]
+                tfs = np.concatenate([t for _, t in parts]) if len(parts) > 1 else parts[0][1]
+                # Document frequency is the number of live documents in the term's postings
+                df = np.count_nonzero(self._lengths[docs]) if has_dead else len(docs)
+                if df == 0:
+                    continue
+                idf = math.log(1 + (n - df + 0.5) / (df + 0.5))
+                tfs = tfs.astype(np.float32)
+                all_docs.append(docs)
+                all_scores.append(tfs * (idf * (self.k1 + 1)) / (tfs + norms[docs]))
+            if not all_docs:
+                return []
+
+            # Sum each document's score over the query terms (indexed by document id), then take the k best
+            scores = np.bincount(np.concatenate(all_docs), weights=np.concatenate(all_scores))
+            if len(scores) > k:
+                top = np.argpartition(-scores, k - 1)[:k]
+            else:
+                top = np.arange(len(scores))
+            top = top[scores[top] > 0]
+            top = top[np.argsort(-scores[top], kind="stable")]
+
+            marks = ",".join("?" * len(top))
+            found = {doc: (key, meta) for doc, key, meta in
+                     self._db.execute(f"SELECT id, key, meta FROM docs WHERE id IN ({marks})", [int(d) for d in top])}
+            return [(float(scores[d]), found[d][0], json.loads(found[d][1])) for d in top]
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+def fuse(rankings, k=5, offset=60):
+    # Reciprocal rank fusion: merges ranked lists of result keys into one list of the 'k' best keys.
+    # Each list adds 1 / (offset + rank) to a key's score, so a key near the top of any list ranks well
+    scores = {}
+    for ranking in rankings:
+        for rank, key in enumerate(ranking):
+            scores[key] = scores.get(key, 0.0) + 1 / (offset + rank + 1)
+    return heapq.nlargest(k, scores, key=scores.get)
+
+
+def normalize_question(question):
+    # Case, spacing and end punctuation don't change a question
+    return re.sub(r"\s+", " ", question.lower()).strip().rstrip("?.! ")
+
+
+class AnswerCache:
+    """
+    Answers to earlier questions, found again by the meaning of the question,
+    in a single SQLite file.
+
+    A question asked again with the same words (ignoring case, spacing and
+    end punctuation) is answered without any request. Otherwise, once the
+    question is embedded, the stored question most similar to it is used if
+    the cosine similarity is at least `threshold`. Entries older than
+    `ttl` seconds (None = no limit) are dropped, and past `max_entries` the
+    least recently used ones are evicted. Each answer remembers the notes it
+    was answered from; `sync_notes` drops answers whose notes were changed or
+    removed, and every answer when a note is added.
+    """
+
+    def __init__(self, path, threshold=0.93, max_entries=2000, ttl=7 * 24 * 3600):
+        self.path = path
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+        # One connection shared by threads, guarded by a lock
+        self._lock = threading.Lock()
+        folder = os.path.dirname(path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("CREATE TABLE IF NOT EXISTS answers (id INTEGER PRIMARY KEY, question TEXT UNIQUE NOT NULL, "
+                         "embedding BLOB NOT NULL, answer TEXT NOT NULL, sources TEXT NOT NULL, "
+                         "created REAL NOT NULL, last_used REAL NOT NULL)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS notes (path TEXT PRIMARY KEY, signature TEXT NOT NULL)")
+        self._db.commit()
+        # Normalized embeddings of the stored questions, one row per id in self._ids; rebuilt after changes
+        self._ids = None
+        self._matrix = None
+
+    def _expire(self):
+        if self.ttl is not None:
+            if self._db.execute("DELETE FROM answers WHERE created < ?", (time.time() - self.ttl,)).rowcount:
+                self._ids = None
+
+    def _load_matrix(self):
+        if self._ids is None:
+            rows = self._db.execute("SELECT id, embedding FROM answers").fetchall()
+            self._ids = [row[0] for row in rows]
+            self._matrix = np.stack([np.frombuffer(row[1], dtype=np.float32) for row in rows]) if rows else None
+
+    def _hit(self, entry_id, answer):
+        self.hits += 1
+        # Bump the entry so it is the last to be evicted
+        self._db.execute("UPDATE answers SET last_used = ? WHERE id = ?", (time.time(), entry_id))
+        self._db.commit()
+        return answer
+
+    def get(self, question, embedding=None):
+        # The cached answer for 'question', or None. Without 'embedding' only an exact repeat is found
+        with self._lock:
+            self._expire()
+            row = self._db.execute("SELECT id, answer FROM answers WHERE question = ?",
+                                   (normalize_question(question),)).fetchone()
+            if row is not None:
+                return self._hit(*row)
+            if embedding is None:
+                return None
+
+            self._load_matrix()
+            if self._matrix is not None:
+                query = normalize(np.asarray(embedding, dtype=np.float32).reshape(1, -1))[0]
+                if query.shape[0] == self._matrix.shape[1]:
+                    similarity = self._matrix @ query
+                    best = int(np.argmax(similarity))
+                    if similarity[best] >= self.threshold:
+                        entry_id = self._ids[best]
+                        answer = self._db.execute("SELECT answer FROM answers WHERE id = ?", (entry_id,)).fetchone()[0]
+                        return self._hit(entry_id, answer)
+            self.misses += 1
+            return None
+
+    def put(self, question, embedding, answer, sources):
+        # Stores the answer with the note files it was answered from
+        vector = normalize(np.asarray(embedding, dtype=np.float32).reshape(1, -1))[0]
+        now = time.time()
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO answers (question, embedding, answer, sources, created, last_used) "
+                             "VALUES (?, ?, ?, ?, ?, ?)",
+                             (normalize_question(question), vector.tobytes(), answer, json.dumps(sorted(sources)), now, now))
+            # Evict the least recently used entries past max_entries
+            self._db.execute("DELETE FROM answers WHERE id IN (SELECT id FROM answers ORDER BY last_used DESC "
+                             "LIMIT -1 OFFSET ?)", (self.max_entries,))
+            self._db.commit()
+            self._ids = None
+
+    def invalidate(self, sources):
+        # Drops every answer that used one of the given note files
+        sources = set(sources)
+        with self._lock:
+            stale = [entry_id for entry_id, used in self._db.execute("SELECT id, sources FROM answers")
+                     if sources.intersection(json.loads(used))]
+            self._db.executemany("DELETE FROM answers WHERE id = ?", ((entry_id,) for entry_id in stale))
+            self._db.commit()
+            self._ids = None
+        return len(stale)
+
+    def clear(self):
+        with self._lock:
+            self._db.execute("DELETE FROM answers")
+            self._db.commit()
+            self._ids = None
+
+    def sync_notes(self, signatures):
+        # Compares the notes ({path: signature}, e.g. content hashes from ingest_notes) with the ones the answers were
+        # made from. A changed or removed note drops the answers that used it. A new note could answer
+        # any question (including ones the notes didn't cover before), so it drops every answer
+        with self._lock:
+            old = dict(self._db.execute("SELECT path, signature FROM notes"))
+        changed = [path for path, signature in old.items() if signatures.get(path) != signature]
+        if set(signatures) - set(old):
+            self.clear()
+        elif changed:
+            self.invalidate(changed)
+        with self._lock:
+            self._db.execute("DELETE FROM notes")
+            self._db.executemany("INSERT INTO notes (path, signature) VALUES (?, ?)", signatures.items())
+            self._db.commit()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+def load_manifest(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def save_manifest(path, manifest):
+    # Written next to the old one and swapped in, so a crash never leaves half a manifest
+    with open(path + ".tmp", "w") as f:
+        json.dump(manifest, f)
+    os.replace(path + ".tmp", path)
+
+
+def ingest_notes(client, folder, store, index, manifest_path, embed_model, chunk_chars=2000, workers=4, batch_size=256):
+    # Brings the vector store and keyword index up to date with the notes in 'folder'.
+    # The manifest records the size, mtime, content hash and chunk count of every note ingested. A note
+    # with the same size and mtime is skipped without being read, and one whose hash hasn't changed
+    # (touched or copied back) only gets its manifest entry updated. The chunks of changed, new and
+    # deleted notes are removed from both indexes before the new chunks are added, so a run that
+    # crashed halfway is cleaned up by the next one. Reading and splitting notes, and the embedding
+    # requests, run in a pool of 'workers' threads. Returns the new manifest and counts of what changed
+    old_manifest = load_manifest(manifest_path)
+    paths = find_notes(folder)
+
+    def check(path):
+        # Returns the path, its manifest entry, and its chunks if it has to be (re)ingested
+        st = os.stat(path)
+        old = old_manifest.get(path)
+        if old is not None and old["size"] == st.st_size and old["mtime_ns"] == st.st_mtime_ns:
+            return path, old, None
+        with open(path, "rb") as f:
+            data = f.read()
+        entry = {"size": st.st_size, "mtime_ns": st.st_mtime_ns, "sha256": hashlib.sha256(data).hexdigest()}
+        if old is not None and old["sha256"] == entry["sha256"]:
+            entry["chunks"] = old["chunks"]
+            return path, entry, None
+        chunks = split_note(data.decode("utf-8", errors="replace"), chunk_chars)
+        entry["chunks"] = len(chunks)
+        return path, entry, chunks
+
+    stats = {"unchanged": 0, "added": 0, "changed": 0, "removed": 0, "chunks": 0}
+    manifest = {}
+    todo = []
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for path, entry, chunks in pool.map(check, paths):
+            manifest[path] = entry
+            if chunks is None:
+                stats["unchanged"] += 1
+                continue
+            stats["changed" if path in old_manifest else "added"] += 1
+            todo.extend({"source": path, "chunk": i, "text": text} for i, text in enumerate(chunks))
+
+        # Drop everything stored for notes that are gone or about to be re-added
+        removed = set(old_manifest) - set(manifest)
+        stats["removed"] = len(removed)
+        stale = removed | {meta["source"] for meta in todo}
+        if stale:
+            index.delete_many([chunk_key({"source": store.rows[row][0], "chunk": store.rows[row][1]})
+                               for row in store.rows_where("source", stale)])
+            store.delete_where("source", stale)
+
+        # Embed the new chunks in batches, several requests at a time, adding each batch as it comes back
+        batches = [todo[i:i + batch_size] for i in range(0, len(todo), batch_size)]
+        vectors = pool.map(lambda batch: embed(client, [meta["text"] for meta in batch], embed_model, batch_size), batches)
+        for batch, batch_vectors in zip(batches, vectors):
+            store.add(batch_vectors, batch)
+            index.add_many((chunk_key(meta), meta["text"], meta) for meta in batch)
+            stats["chunks"] += len(batch)
+
+    if manifest != old_manifest:
+        save_manifest(manifest_path, manifest)
+    return manifest, stats
+
+
+@lru_cache(maxsize=None)
+def get_encoder(model):
+    # Building an encoder is slow, so each model's encoder is only built once per process
+    import tiktoken
+    return tiktoken.encoding_for_model(model)
+
+
+def pack_sections(sections, token_budget, model):
+    # Groups consecutive note sections (dicts with 'source' and 'text') so each group's text is about
+    # 'token_budget' tokens at most. A section longer than the budget goes in a group on its own
+    enc = get_encoder(model)
+    groups = []
+    group, group_tokens = [], 0
+    for section in sections:
+        n = len(enc.encode(section["text"]))
+        if group and group_tokens + n > token_budget:
+            groups.append(group)
+            group, group_tokens = [], 0
+        group.append(section)
+        group_tokens += n
+    if group:
+        groups.append(group)
+    return groups
+
+
+def parse_cards(text):
+    # Cards from a reply with one JSON object per line ({"front": ..., "back": ..., "source": ...}).
+    # Code fences, blank lines and anything that isn't a card with a front and a back are skipped
+    cards = []
+    for line in text.splitlines():
+        line = line.strip().rstrip(",")
+        if not line.startswith("{"):
+            continue
+        try:
+            card = json.loads(line)
+        except ValueError:
+            continue
+        if isinstance(card, dict) and str(card.get("front", "")).strip() and str(card.get("back", "")).strip():
+            cards.append({"front": str(card["front"]).strip(), "back": str(card["back"]).strip(),
+                          "source": str(card.get("source", "")).strip()})
+    return cards
+
+
+class CardDeduper:
+    """
+    Streaming near-duplicate filter for generated cards.
+
+    A card is a duplicate if the words of its front (lowercased, without
+    stopwords) overlap an earlier card's with a Jaccard similarity of at
+    least `threshold`. Earlier cards sharing a word are found through an
+    inverted index, so each card is only compared with likely matches.
+    """
+
+    def __init__(self, threshold=0.8):
+        self.threshold = threshold
+        self._words = []
+        self._by_word = {}
+
+    def add(self, card):
+        # Returns True and remembers the card if it is new, False if it is a near duplicate
+        words = set(terms(card["front"]))
+        candidates = {i for w in words for i in self._by_word.get(w, ())}
+        for i in candidates:
+            other = self._words[i]
+            if len(words & other) / max(1, len(words | other)) >= self.threshold:
+                return False
+        for w in words:
+            self._by_word.setdefault(w, []).append(len(self._words))
+        self._words.append(words)
+        return True
+
+
+def generate_cards(client, model, sys_prompt, card_prompt, sections, out_path, token_budget=6000, workers=4,
+                   kind="flashcard", max_output_tokens=2000, deduper=None):
+    # Makes cards from note sections: sections are packed into requests of about 'token_budget' tokens,
+    # up to 'workers' requests run at once, and the cards of each reply are parsed, filtered for near
+    # duplicates and appended to 'out_path' (one JSON object per line, tagged with 'kind') as soon as the
+    # reply comes back. Returns counts of cards written, duplicates dropped and failed requests
+    deduper = deduper if deduper is not None else CardDeduper()
+    stats = {"requests": 0, "cards": 0, "duplicates": 0, "failed": 0}
+    groups = pack_sections(sections, token_budget, model)
+
+    def make(group):
+        text = "\n\n---\n\n".join(f"[{section['source']}]\n{section['text']}" for section in group)
+        return parse_cards(ask(client, model, sys_prompt, card_prompt, text, max_output_tokens))
+
+    with open(out_path, "a", encoding="utf-8") as out, ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(make, group) for group in groups]
+        for future in as_completed(futures):
+            stats["requests"] += 1
+            try:
+                cards = future.result()
+            except Exception as e:
+                stats["failed"] += 1
+                print(f"Card request failed: {e}")
+                continue
+            for card in cards:
+                if not deduper.add(card):
+                    stats["duplicates"] += 1
+                    continue
+                out.write(json.dumps({"kind": kind, **card}) + "\n")
+                stats["cards"] += 1
+            out.flush()
+    return stats
@@ -1,75 +1,485 @@
-import PyPDF2 as pdfr
 import re
-import tiktoken
-from dotenv import load_dotenv
+import codecs
+import itertools
+import mmap
 import os
-from openai import OpenAI
-load_dotenv()
-client = OpenAI(api_key=os.getenv("OPEN_AI_KEY"))
+import threading
+import time
+from collections import deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import lru_cache
 
-def pdf_reader(pdf_path, txt_path):
-    # Open pdf file in rb mode
+# PyPDF2, tiktoken, openai and dotenv are slow to import, so they are only imported by the
+# functions that need them. A txt-only run never loads PyPDF2, and a run on the fake backend
+# never loads openai or needs an API key
+
+def make_client(backend="openai", **options):
+    # Any object with a client.responses.create(model=..., input=..., max_output_tokens=...) method
+    # returning something with .output_text works as a client. "fake" answers locally (see fake_llm.py)
+    # and takes FakeClient's options (latency, jitter, error_rate, rate_limit_rate, token_delay, seed)
+    if backend == "openai":
+        from dotenv import load_dotenv
+        from openai import OpenAI
+        load_dotenv()
+        return OpenAI(api_key=os.getenv("OPEN_AI_KEY"), **options)
+    elif backend == "fake":
+        from fake_llm import FakeClient
+        return FakeClient(**options)
+    raise ValueError(f"Unknown backend: {backend}")
+
+@lru_cache(maxsize=None)
+def get_client():
+    # The OpenAI client is built the first time it is needed and then reused for every request
+    return make_client("openai")
+
+def __getattr__(name):
+    # Keeps 'af.client' working: it is built on first use instead of at import time
+    if name == "client":
+        return get_client()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+def file_kind(path):
+    # "pdf" or "txt" going by the file's extension (in any case), None for any other file.
+    # Only the extension counts, so report.pdf.txt is a txt file
+    ext = os.path.splitext(path)[1].lower()
+    return ext[1:] if ext in (".pdf", ".txt") else None
+
+# PdfReader for the file a worker process was started on (see pdf_pages with workers > 1)
+_worker_reader = None
+
+def _open_worker_reader(pdf_path):
+    # Runs once in each worker process so the pdf is only parsed once per process, not once per shard
+    import PyPDF2 as pdfr
+    global _worker_reader
+    _worker_reader = pdfr.PdfReader(pdf_path)
+
+def _extract_shard(page_range):
+    start, stop = page_range
+    return [_worker_reader.pages[i].extract_text() + "\n" for i in range(start, stop)]
+
+def pdf_pages(pdf_path, start=0, stop=None, workers=1, shard_size=8):
+    # Yields the text of one page at a time so later stages can start before the whole pdf is read.
+    # 'start' and 'stop' pick a range of pages (0-based, stop excluded) so huge files can be done in shards.
+    # With workers > 1 the pages are split into shards of 'shard_size' pages and extracted
+    # in a process pool, then handed back in page order
+    import PyPDF2 as pdfr
     with open(pdf_path, "rb") as pdf_file:
         reader = pdfr.PdfReader(pdf_file)
-        text = ""
+        total = len(reader.pages)
+        stop = total if stop is None else min(stop, total)
+
+        if workers <= 1:
+            for i in range(start, stop):
+                yield reader.pages[i].extract_text() + "\n"
+            return
+
+    shards = ((s, min(s + shard_size, stop)) for s in range(start, stop, shard_size))
+    with ProcessPoolExecutor(max_workers=workers, initializer=_open_worker_reader, initargs=(pdf_path,)) as executor:
+        # Only 2 * workers shards are in flight, topped up as each one is handed on, so when the
+        # later stages are slow (e.g. waiting on LLM requests) the text of the rest of the pdf
+        # doesn't pile up in memory
+        pending = deque(executor.submit(_extract_shard, s) for s in itertools.islice(shards, 2 * workers))
+        while pending:
+            texts = pending.popleft().result()
+            for s in itertools.islice(shards, 1):
+                pending.append(executor.submit(_extract_shard, s))
+            yield from texts
+
+def pdf_reader(pdf_path, txt_path, start=0, stop=None, workers=1):
+    # Read the whole pdf (or a range of its pages) into one string (join once instead of growing the string page by page)
+    return "".join(pdf_pages(pdf_path, start, stop, workers))
+
+def txt_pages(txt_path, window=1 << 18):
+    # Yields a txt file in windows of about 'window' bytes through a memory map, so a multi-gigabyte
+    # file never has to fit in memory. Windows are cut after whitespace so no word is split between
+    # two of them, and the incremental decoder keeps utf-8 characters whole. Line endings are turned
+    # into "\n" like text mode would (a "\r" at the end of a window waits for the next one, in case
+    # it is the first half of a "\r\n"). Pages already read are
+    # handed back to the OS so they don't stay in this process's resident memory
+    with open(txt_path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+            start = 0
+            released = 0
+            carry = ""
+            while start < size:
+                end = min(start + window, size)
+                if end < size:
+                    cut = max(mm.rfind(b" ", start, end), mm.rfind(b"\n", start, end))
+                    if cut > start:
+                        end = cut + 1
+                text = carry + decoder.decode(mm[start:end], final=end == size)
+                carry = ""
+                if end < size and text.endswith("\r"):
+                    carry, text = "\r", text[:-1]
+                text = text.replace("\r\n", "\n").replace("\r", "\n")
+                if text:
+                    yield text
+                start = end
 
-        # Loop through each page and extract text
-        for page in reader.pages:
-            text += page.extract_text() + "\n"
+                if hasattr(mm, "madvise") and hasattr(mmap, "MADV_DONTNEED"):
+                    done = start - start % mmap.PAGESIZE
+                    if done > released:
+                        mm.madvise(mmap.MADV_DONTNEED, released, done - released)
+                        released = done
 
-    return text
+def clean_stream(pieces):
+    # Streaming version of text_cleaner: takes pieces of text (e.g. pages) and yields cleaned pieces.
+    # Joined together, the output is the same as text_cleaner on the joined input
+    carry = ""            # trailing "-" that may be a word broken across two pieces
+    pending_space = False # whitespace seen at the end of the last piece, emitted only if more text follows
+    started = False       # nothing emitted yet means leading whitespace is dropped (like strip())
+
+    for piece in pieces:
+        text = carry + piece
+        carry = ""
+        if text.endswith("-"):
+            carry = "-"
+            text = text[:-1]
+
+        # Remove broken hyphens, newlines, and extra spaces
+        text = text.replace("-\n", "")
+        text = text.replace("\n", " ")
+        text = re.sub(r"\s+", " ", text)
+        if not text:
+            continue
+
+        if text[0] == " ":
+            pending_space = True
+            text = text[1:]
+        trailing = text.endswith(" ")
+        if trailing:
+            text = text[:-1]
+
+        if text:
+            yield (" " + text) if (pending_space and started) else text
+            started = True
+            pending_space = trailing
+        else:
+            pending_space = pending_space or trailing
+
+    if carry:
+        yield (" " + carry) if (pending_space and started) else carry
 
 def text_cleaner(text):
     # Remove broken hyphens, newlines, and extra spaces
-    text = text.replace("-\n", "")  # Remove newlines
-    text = text.replace("\n", " ")
-    text = re.sub(r"\s+", " ", text)
+    return "".join(clean_stream([text]))
+
+# One chunk of a text: token range [tok_start, tok_end) and the matching character range [char_start, char_end) of the text
+Span = namedtuple("Span", ["tok_start", "tok_end", "char_start", "char_end", "text"])
+
+@lru_cache(maxsize=None)
+def get_encoder(model):
+    # Building an encoder is slow, so each model's encoder is only built once per process
+    import tiktoken
+    return tiktoken.encoding_for_model(model)
+
+def _char_start(data, i):
+    # Index of the first byte of the utf-8 character that byte i of 'data' is part of
+    # (i itself unless the bytes before it are an unfinished character)
+    j = i
+    while j > 0 and i - j < 3 and 0x80 <= data[j - 1] < 0xC0:
+        j -= 1
+    if j > 0 and data[j - 1] >= 0xC0:
+        lead = data[j - 1]
+        length = 2 if lead < 0xE0 else 3 if lead < 0xF0 else 4
+        if i - (j - 1) < length:
+            return j - 1
+    return i
+
+def span_stream(pieces, chunk_size, overlap, model):
+    # Yields a Span for each chunk of about 'chunk size' tokens with 'overlap' tokens shared between
+    # chunks, built from a stream of text pieces (positions count from the start of the stream).
+    # Every token is decoded once: the bytes of the overlap are kept from the chunk before instead of
+    # decoding the whole window again. Only the current piece's tokens and one chunk are held in memory.
+    # A token starting in the middle of a utf-8 character belongs to that character
+    enc = get_encoder(model)
+    step = chunk_size - overlap
+    tokens = []          # tokens from index tok_base on
+    tok_base = 0
+    data = bytearray()   # utf-8 bytes of the tokens decoded so far, from stream byte byte_base on
+    byte_base = 0
+    decoded = 0          # tokens before this index are in 'data'
+    # (byte, char) offset in the stream of each chunk start and end reached so far
+    marks = {0: (0, 0)}
+    last_mark = (0, 0)
+
+    def mark(upto):
+        # Decodes the tokens up to 'upto' and records where that token starts. Chunk starts before
+        # it are recorded first (with a large overlap, they come before the end of the chunk before)
+        if upto in marks:
+            return
+        for t in range((decoded // step + 1) * step, upto, step):
+            record(t)
+        record(upto)
+
+    def record(upto):
+        nonlocal decoded, last_mark
+        data.extend(enc.decode_bytes(tokens[decoded - tok_base:upto - tok_base]))
+        decoded = upto
+        b = byte_base + _char_start(data, len(data))
+        last_byte, last_char = last_mark
+        last_mark = marks[upto] = (b, last_char + len(data[last_byte - byte_base:b - byte_base].decode("utf-8")))
+
+    def make(start, end):
+        # The chunk [start, end) as a Span
+        nonlocal byte_base
+        mark(end)
+        (b_start, c_start), (b_end, c_end) = marks[start], marks[end]
+        span = Span(start, end, c_start, c_end, data[b_start - byte_base:b_end - byte_base].decode("utf-8"))
 
-    return text.strip()
+        # Everything before the next chunk's start has been used (the tokens are dropped once per piece)
+        nxt = start + step
+        if nxt in marks:
+            del data[:marks[nxt][0] - byte_base]
+            byte_base = marks[nxt][0]
+            for t in [t for t in marks if t < nxt]:
+                del marks[t]
+        return span
+
+    start = 0
+    # How far the chunks sent so far reach
+    sent = 0
+    for piece in pieces:
+        tokens.extend(enc.encode(piece))
+        while tok_base + len(tokens) - start >= chunk_size:
+            yield make(start, start + chunk_size)
+            sent = start + chunk_size
+            start += step
+        del tokens[:start - tok_base]
+        tok_base = start
+
+    # Whatever is left is shorter than a full chunk. If it is only the overlap of the last
+    # chunk, it was already sent and another chunk would just repeat it
+    total = tok_base + len(tokens)
+    while sent < total:
+        yield make(start, min(start + chunk_size, total))
+        sent = start + chunk_size
+        start += step
+
+def chunk_spans(text, chunk_size, overlap, model):
+    # The Spans of 'text' (see span_stream); each span's text is text[char_start:char_end]
+    return span_stream([text], chunk_size, overlap, model)
 
 def chunk(text, chunk_size, overlap, model):
     # Splits text into chunks of about 'chunk size' tokens with 'overlap' tokens shared between chunks
+    return [span.text for span in chunk_spans(text, chunk_size, overlap, model)]
 
-    # grabs model specific encoder and encodes token
-    enc = tiktoken.encoding_for_model(model)
-    tokens = enc.encode(text)
+def chunk_stream(pieces, chunk_size, overlap, model):
+    # Same windows as chunk, but built from a stream of text pieces, yielding each chunk's text as soon as it is full
+    for span in span_stream(pieces, chunk_size, overlap, model):
+        yield span.text
 
-    chunks = []
-    start = 0
+# Rolling (gear) hash for content-defined chunking. Each token shifts the hash left one bit,
+# so the top bits only depend on about the last 64 tokens
+_MASK64 = (1 << 64) - 1
 
-    # Loop until all tokens are chunked
-    while start < len(tokens):
-        end = start + chunk_size
-        # Grab specific length of token
-        chunk_tokens = tokens[start:end]
-
-        # Append the to the chunk array after decoding back into text
-        chunks.append(enc.decode(chunk_tokens))
-        # Reset the start
-        start += chunk_size - overlap
-
-    return chunks
-
-def summarize_chunk(client, model, sys_prompt, task_prompt, chunk_text):
-    resp = client.responses.create(
-        model = model,
-        input=[
-            {"role": "system", "content": [{"type": "input_text", "text": sys_prompt}]},
-            {"role": "user",   "content": [{"type": "input_text", "text": f"{task_prompt}\n\n---\n{chunk_text}"}]},
-        ],
-        max_output_tokens = 500
-    )
-    return resp.output_text
-
-def synthesize(client, model, sys_prompt, synth_prompt, synth_input):
-    summary = client.responses.create(
-        model = model,
-        input=[
-            {"role": "system", "content": [{"type": "input_text", "text": sys_prompt}]},
-            {"role": "user",   "content": [{"type": "input_text", "text": f"{synth_prompt}\n\n---\n{synth_input}"}]},
-        ],
-        max_output_tokens = 1000
+def _gear(token):
+    # Spreads a token id over 64 bits
+    x = ((token + 1) * 0x9E3779B97F4A7C15) & _MASK64
+    return x ^ (x >> 29)
+
+def _boundary_threshold(min_size, max_size, chunk_size):
+    # Hash threshold under which a token ends a chunk. With a boundary chance p per token after
+    # min_size, capped at max_size, chunks average min_size + (1 - (1 - p)^(max_size - min_size)) / p
+    # tokens; p is found by bisection so that comes out at chunk_size
+    span = max_size - min_size
+    gap = min(max(1, chunk_size - min_size), span)
+    lo, hi = 0.0, 1.0
+    for _ in range(60):
+        p = (lo + hi) / 2
+        mean_gap = (1 - (1 - p) ** span) / p
+        if mean_gap > gap:
+            lo = p
+        else:
+            hi = p
+    return int(hi * (1 << 64))
+
+def cdc_chunk_stream(pieces, chunk_size, model):
+    # Content-defined chunking: a chunk ends where the rolling hash of the last ~64 tokens hits a
+    # boundary pattern, so boundaries follow the text itself instead of fixed token positions.
+    # Inserting a paragraph only changes the chunks around it; later chunks come out identical and
+    # their cached summaries are reused. Chunks are between chunk_size/2 and 1.5 * chunk_size tokens
+    # (about chunk_size on average) and don't overlap, since an overlap would tie each chunk to the one before it
+    enc = get_encoder(model)
+    min_size = max(1, chunk_size // 2)
+    max_size = max(min_size + 1, chunk_size * 3 // 2)
+    threshold = _boundary_threshold(min_size, max_size, chunk_size)
+
+    tokens = []
+    h = 0
+    for piece in pieces:
+        for t in enc.encode(piece):
+            tokens.append(t)
+            h = ((h << 1) + _gear(t)) & _MASK64
+            if (len(tokens) >= min_size and h < threshold) or len(tokens) >= max_size:
+                yield enc.decode(tokens)
+                tokens = []
+                h = 0
+    if tokens:
+        yield enc.decode(tokens)
+
+class StreamInterrupted(Exception):
+    # A streamed request failed after some of its tokens were already handed out, so it isn't retried
+    pass
+
+def _ask(client, model, sys_prompt, prompt, text, max_output_tokens, cache=None, tracer=None, kind="request", scheduler=None, on_token=None):
+    # Sends one system + user request, answering from the cache when the exact same request was made before.
+    # With a tracer, the latency and token counts of the request are recorded under 'kind'.
+    # With a scheduler, the request waits for a free slot and token budget and is retried on transient errors.
+    # With on_token, the answer is streamed and on_token is called with each piece of text as it arrives
+    start = time.perf_counter()
+    first_token = None
+    key = None
+    if cache is not None:
+        key = cache.key(model, sys_prompt, prompt, text, max_output_tokens)
+        cached = cache.get(key)
+        if cached is not None:
+            if on_token is not None:
+                on_token(cached)
+            if tracer is not None:
+                # Nothing was sent, so there are no tokens to count
+                _trace_request(tracer, kind, start, model, text, 0, None, cached=True)
+            return cached
+
+    # Counted once here for both the scheduler's token budget and the trace
+    input_tokens = None
+    if scheduler is not None or tracer is not None:
+        input_tokens = _prompt_tokens(model, sys_prompt, prompt) + len(get_encoder(model).encode(text))
+
+    def send():
+        nonlocal first_token
+        resp = client.responses.create(
+            model = model,
+            input=[
+                {"role": "system", "content": [{"type": "input_text", "text": sys_prompt}]},
+                {"role": "user",   "content": [{"type": "input_text", "text": f"{prompt}\n\n---\n{text}"}]},
+            ],
+            max_output_tokens = max_output_tokens,
+            stream = on_token is not None
+        )
+        if on_token is None:
+            return resp.output_text
+
+        pieces = []
+        try:
+            for event in resp:
+                if event.type == "response.output_text.delta":
+                    if first_token is None:
+                        first_token = time.perf_counter() - start
+                    pieces.append(event.delta)
+                    on_token(event.delta)
+        except Exception as e:
+            if pieces:
+                raise StreamInterrupted(f"stream failed after {len(pieces)} pieces: {e!r}") from e
+            raise
+        return "".join(pieces)
+
+    retries = 0
+    try:
+        if scheduler is None:
+            output = send()
+        else:
+            output, retries = scheduler.call(send, input_tokens + max_output_tokens)
+    except Exception as e:
+        if tracer is not None:
+            _trace_request(tracer, kind, start, model, text, input_tokens, "", error=repr(e))
+        raise
+
+    if tracer is not None:
+        _trace_request(tracer, kind, start, model, text, input_tokens, output, retries=retries, first_token=first_token)
+    if cache is not None:
+        cache.put(key, output)
+    return output
+
+@lru_cache(maxsize=256)
+def _prompt_tokens(model, sys_prompt, prompt):
+    # Tokens of the system prompt and the prompt with its "---" separator. Every request of a stage
+    # has the same prompts, so they are only tokenized once
+    enc = get_encoder(model)
+    return len(enc.encode(sys_prompt)) + len(enc.encode(f"{prompt}\n\n---\n"))
+
+def _trace_request(tracer, kind, start, model, text, input_tokens, output, cached=False, error=None, retries=0, first_token=None):
+    # 'output' is None for cache hits, which count no output tokens either
+    extra = {"first_token_seconds": first_token} if first_token is not None else {}
+    tracer.record_request(
+        kind,
+        time.perf_counter() - start,
+        input_tokens=input_tokens,
+        output_tokens=len(get_encoder(model).encode(output)) if output else 0,
+        retries=retries,
+        cached=cached,
+        error=error,
+        input_chars=len(text),
+        **extra,
     )
-    return summary.output_text
 
+def summarize_chunk(client, model, sys_prompt, task_prompt, chunk_text, max_output_tokens=500, cache=None, tracer=None, kind="chunk", scheduler=None, on_token=None):
+    return _ask(client, model, sys_prompt, task_prompt, chunk_text, max_output_tokens, cache, tracer, kind, scheduler, on_token)
+
+def synthesize(client, model, sys_prompt, synth_prompt, synth_input, max_output_tokens=1000, cache=None, tracer=None, scheduler=None, on_token=None):
+    return _ask(client, model, sys_prompt, synth_prompt, synth_input, max_output_tokens, cache, tracer, "synthesize", scheduler, on_token)
+
+def summarize_chunks(client, model, sys_prompt, task_prompt, chunks, max_workers=4, cache=None, executor=None, tracer=None, kind="chunk", scheduler=None):
+    # Summarizes every chunk with at most 'max_workers' requests in flight at once.
+    # 'chunks' can be a generator: a chunk is sent as soon as it is produced, and at most
+    # 2 * max_workers chunks wait in memory. Results come back in chunk order.
+    # Pass an 'executor' to share one pool of request threads between several documents
+    if executor is None:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return summarize_chunks(client, model, sys_prompt, task_prompt, chunks, max_workers, cache, executor, tracer, kind, scheduler)
+
+    slots = threading.BoundedSemaphore(2 * max_workers)
+    futures = []
+    for c in chunks:
+        slots.acquire()
+        future = executor.submit(summarize_chunk, client, model, sys_prompt, task_prompt, c,
+                                 cache=cache, tracer=tracer, kind=kind, scheduler=scheduler)
+        future.add_done_callback(lambda f: slots.release())
+        futures.append(future)
+    return [f.result() for f in futures]
+
+def batch_by_tokens(texts, token_budget, fan_in, model):
+    # Groups consecutive texts so each group has at most 'fan_in' texts and about 'token_budget' tokens.
+    # Every group except a leftover last one gets at least 2 texts, so each reduce level always shrinks the list
+    enc = get_encoder(model)
+    groups = []
+    group, group_tokens = [], 0
+    for t in texts:
+        n = len(enc.encode(t))
+        if len(group) >= 2 and (len(group) >= fan_in or group_tokens + n > token_budget):
+            groups.append(group)
+            group, group_tokens = [], 0
+        group.append(t)
+        group_tokens += n
+    if group:
+        groups.append(group)
+    return groups
+
+def tree_synthesize(client, model, sys_prompt, merge_prompt, synth_prompt, summaries, fan_in=8, token_budget=12000, max_workers=4, cache=None, executor=None, tracer=None, scheduler=None, on_token=None):
+    # Map-reduce over the summaries: while they don't fit in one synthesis request, merge them in
+    # token-budgeted batches of up to 'fan_in' (batches run in parallel), then synthesize what is left.
+    # Only the final synthesis is streamed to on_token. Returns the final summary and a list with the timing of each level
+    enc = get_encoder(model)
+    timings = []
+    level = 0
+    while True:
+        start = time.perf_counter()
+        synth_input = "\n\n---\n\n".join(summaries)
+        # A single summary can't be merged any further, so it goes to synthesis even if it is over budget
+        if len(summaries) == 1 or (len(summaries) <= fan_in and len(enc.encode(synth_input)) <= token_budget):
+            final = synthesize(client, model, sys_prompt, synth_prompt, synth_input, cache=cache, tracer=tracer,
+                               scheduler=scheduler, on_token=on_token)
+            timings.append({"level": level, "inputs": len(summaries), "outputs": 1, "seconds": time.perf_counter() - start})
+            return final, timings
 
+        groups = batch_by_tokens(summaries, token_budget, fan_in, model)
+        batches = ["\n\n---\n\n".join(g) for g in groups]
+        merged = summarize_chunks(client, model, sys_prompt, merge_prompt, batches, max_workers=max_workers, cache=cache,
+                                  executor=executor, tracer=tracer, kind="merge", scheduler=scheduler)
+        timings.append({"level": level, "inputs": len(summaries), "outputs": len(merged), "seconds": time.perf_counter() - start})
+        summaries = merged
+        level += 1
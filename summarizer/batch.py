@@ -0,0 +1,234 @@
+## Summarizes a whole directory (or a manifest listing files) without prompting, and can pick up where a crashed run stopped
+import argparse
+import hashlib
+import itertools
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import aid_funct as af
+import planner
+import summarizer as sm
+from cache import SummaryCache
+from tracing import Tracer
+
+
+class Journal:
+    """
+    Append-only NDJSON log of a batch run.
+
+    Every LLM result is written as soon as it comes back, and every finished
+    document is marked done, so rerunning the same batch skips finished
+    documents and reuses the chunk summaries of half-finished ones.
+    It has the same key/get/put interface as SummaryCache so it can be passed
+    anywhere a cache is expected; misses fall through to `cache` if given.
+    Results and documents of a `backend` other than "openai" are logged under
+    their own keys, so a dry run never passes for real output.
+    """
+
+    def __init__(self, path, cache=None, backend="openai"):
+        self.path = path
+        self.cache = cache
+        self.backend = backend
+        self.results = {}
+        self.finished = {}
+        self._lock = threading.Lock()
+
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        # Last line of a crashed run may be half written
+                        continue
+                    if entry["type"] == "result":
+                        self.results[entry["key"]] = entry["text"]
+                    elif entry["type"] == "done":
+                        self.finished[entry["doc"]] = entry["output"]
+        self._file = open(path, "a")
+
+    def key(self, *fields):
+        key = SummaryCache.key(*fields)
+        return key if self.backend == "openai" else f"{self.backend}:{key}"
+
+    def get(self, key):
+        with self._lock:
+            text = self.results.get(key)
+        if text is None and self.cache is not None:
+            text = self.cache.get(key)
+        return text
+
+    def put(self, key, value):
+        with self._lock:
+            self.results[key] = value
+            self._write({"type": "result", "key": key, "text": value})
+        if self.cache is not None:
+            self.cache.put(key, value)
+
+    def mark_done(self, doc, output):
+        with self._lock:
+            self.finished[doc] = output
+            self._write({"type": "done", "doc": doc, "output": output})
+
+    def mark_failed(self, doc, error):
+        with self._lock:
+            self._write({"type": "failed", "doc": doc, "error": error})
+
+    def _write(self, entry):
+        self._file.write(json.dumps(entry) + "\n")
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+def find_documents(source):
+    # A directory is searched recursively for pdf and txt files; any other file is read as a manifest with one path per line
+    if os.path.isdir(source):
+        docs = []
+        for folder, _, files in os.walk(source):
+            for name in files:
+                if af.file_kind(name) is not None:
+                    docs.append(os.path.join(folder, name))
+        return sorted(docs)
+
+    with open(source, "r") as f:
+        folder = os.path.dirname(source)
+        return [os.path.join(folder, line.strip()) for line in f if line.strip()]
+
+
+def doc_id(path, backend="openai"):
+    # A document counts as already done only if it hasn't changed since it was summarized (by the same backend)
+    st = os.stat(path)
+    doc = f"{os.path.abspath(path)}:{st.st_size}:{int(st.st_mtime)}"
+    return doc if backend == "openai" else f"{doc}:{backend}"
+
+
+def output_path(out_dir, path, root):
+    # The summary keeps the document's path under 'root' and its extension (reports/a/x.pdf ->
+    # out_dir/a/x.pdf_summary.md), so a.pdf and a.txt, or two report.txt in different folders,
+    # never write the same file. Documents outside 'root' are named after a hash of their full path
+    rel = os.path.relpath(os.path.abspath(path), os.path.abspath(root))
+    if rel.startswith(os.pardir + os.sep) or rel == os.pardir:
+        digest = hashlib.sha256(os.path.abspath(path).encode("utf-8")).hexdigest()[:10]
+        rel = f"{os.path.basename(path)}_{digest}"
+    return os.path.join(out_dir, rel + "_summary.md")
+
+
+def run_batch(docs, session, journal, out_dir, doc_workers=2, tracer=None, root=None):
+    # Summarizes 'docs' with 'doc_workers' documents open at a time, all sharing one session: the same
+    # request threads, open connections and scheduler, so rate limits hit by one document slow down all of them.
+    # The session's cache should be the journal, so every result is logged for resuming.
+    # Summaries are written under 'out_dir' by their path relative to 'root' (the documents' common folder by default)
+    os.makedirs(out_dir, exist_ok=True)
+    if root is None:
+        root = os.path.commonpath([os.path.dirname(os.path.abspath(d)) for d in docs]) if docs else "."
+
+    def is_done(path):
+        # Done only if the summary is where this run would write it: runs that named summaries
+        # by file name alone may have let one document overwrite another's
+        out = journal.finished.get(ids[path])
+        return out == output_path(out_dir, path, root) and os.path.exists(out)
+
+    # A missing or unreadable document fails on its own instead of stopping the batch
+    failed = 0
+    ids = {}
+    for d in docs:
+        try:
+            ids[d] = doc_id(d, journal.backend)
+        except OSError as e:
+            failed += 1
+            journal.mark_failed(os.path.abspath(d), repr(e))
+            print(f"{d} failed: {e!r}")
+
+    todo = [d for d in docs if d in ids and not is_done(d)]
+    print(f"{len(ids) - len(todo)} of {len(docs)} documents already done, {len(todo)} to go")
+
+    def summarize_one(path):
+        doc_tracer = tracer.for_doc(path) if tracer is not None else None
+        try:
+            plan = sm.plan_for(path)
+            # One write, so the plans of documents starting at the same time don't interleave
+            sys.stdout.write(f"{path}\n{planner.format_plan(plan)}\n")
+            final_output, _ = sm.summarize_file(path, session, tracer=doc_tracer, plan=plan)
+        finally:
+            if doc_tracer is not None:
+                # Writes this document's stage totals into the run's trace
+                doc_tracer.close()
+        out = output_path(out_dir, path, root)
+        os.makedirs(os.path.dirname(out), exist_ok=True)
+        with open(out, "w") as f:
+            f.write(final_output)
+        journal.mark_done(ids[path], out)
+        return out
+
+    # Only 'doc_workers' documents are submitted at a time, topped up as each one finishes, so a
+    # stopped run (e.g. Ctrl-C) only waits for the documents already open instead of the whole queue;
+    # the journal picks up the rest on the next run
+    queue = iter(todo)
+    i = 0
+    with ThreadPoolExecutor(max_workers=doc_workers) as documents:
+        futures = {documents.submit(summarize_one, d): d for d in itertools.islice(queue, doc_workers)}
+        while futures:
+            finished, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in finished:
+                path = futures.pop(future)
+                for d in itertools.islice(queue, 1):
+                    futures[documents.submit(summarize_one, d)] = d
+                i += 1
+                try:
+                    print(f"[{i}/{len(todo)}] {path} -> {future.result()}")
+                except Exception as e:
+                    # One bad document shouldn't stop the batch; it is retried on the next run
+                    failed += 1
+                    journal.mark_failed(ids[path], repr(e))
+                    print(f"[{i}/{len(todo)}] {path} failed: {e!r}")
+    return failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Summarize every pdf/txt file in a directory or manifest")
+    parser.add_argument("source", help="directory of documents, or a text file listing one document per line")
+    parser.add_argument("--out", help="directory the summaries are written to (default: summaries, or summaries_fake with --backend fake)")
+    parser.add_argument("--journal", help="progress log used to resume a stopped run (default: batch_journal.ndjson, "
+                                          "or batch_journal_fake.ndjson with --backend fake)")
+    parser.add_argument("--workers", type=int, default=8, help="LLM requests in flight across all documents")
+    parser.add_argument("--docs", type=int, default=2, help="documents processed at the same time")
+    parser.add_argument("--backend", choices=["openai", "fake"], default="openai", help="'fake' answers locally, for dry runs (its answers never go in the shared cache, "
+                             "and its summaries and journal are kept apart from real runs)")
+    parser.add_argument("--chunking", choices=["fixed", "content"], default=sm.CHUNKING,
+                        help="'content' keeps chunk boundaries stable across edits, so revised documents only resend changed chunks")
+    parser.add_argument("--tpm", type=int, default=sm.TOKENS_PER_MINUTE, help="tokens per minute budget for the whole run (0 = none)")
+    parser.add_argument("--trace", default=os.path.join(sm.TRACE_DIR, f"batch_{time.strftime('%Y%m%d-%H%M%S')}.ndjson"),
+                        help="NDJSON file for stage times, request latencies and token counts")
+    parser.add_argument("--no-cache", action="store_true", help=f"don't use the shared cache in {sm.CACHE_PATH}")
+    args = parser.parse_args()
+    sm.CHUNKING = args.chunking
+    fake = args.backend == "fake"
+    out_dir = args.out or ("summaries_fake" if fake else "summaries")
+    journal_path = args.journal or ("batch_journal_fake.ndjson" if fake else "batch_journal.ndjson")
+
+    client = af.make_client("fake") if fake else None
+    cache = None if args.no_cache or fake else SummaryCache(sm.CACHE_PATH)
+    journal = Journal(journal_path, cache, args.backend)
+    tracer = Tracer(args.trace)
+    session = sm.make_session(client, journal, max_workers=args.workers, tokens_per_minute=args.tpm or None)
+    try:
+        root = args.source if os.path.isdir(args.source) else os.path.dirname(args.source) or "."
+        failed = run_batch(find_documents(args.source), session, journal, out_dir, args.docs, tracer, root)
+    finally:
+        session.close()
+        journal.close()
+        if cache is not None:
+            cache.close()
+        sm.print_trace_summary(tracer.close())
+    if failed:
+        print(f"{failed} documents failed; run the same command again to retry them")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+## Throughput benchmark for the summarizer pipeline, run against the offline fake LLM so it needs no API key
+import argparse
+import os
+import random
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import aid_funct as af
+import summarizer as sm
+from scheduler import RequestScheduler
+from session import SummarizerSession
+
+# Small vocabulary for the made-up documents, with some longer words so tokenization isn't trivial
+WORDS = ("the of and to in is was for on that with as by at from this which were are be an data model results "
+         "analysis equation solution measurement temperature probability experiment significant distribution "
+         "hypothesis correlation approximately parameters observations").split()
+
+
+def make_document(folder, n_words, seed=0):
+    # Writes a txt file of 'n_words' random words, in sentences and paragraphs
+    rng = random.Random(seed)
+    path = os.path.join(folder, f"doc_{n_words}.txt")
+    with open(path, "w") as f:
+        for i in range(n_words):
+            f.write(rng.choice(WORDS))
+            f.write(".\n\n" if i % 120 == 119 else ". " if i % 15 == 14 else " ")
+    return path
+
+
+def run_one(path, workers, latency, jitter, error_rate, rate_limit_rate, docs):
+    # Runs in its own process so the peak RSS is only this configuration's
+    client = af.make_client("fake", latency=latency, jitter=jitter, error_rate=error_rate, rate_limit_rate=rate_limit_rate, seed=0)
+    # Short backoff so injected errors don't turn the benchmark into a test of sleep()
+    scheduler = RequestScheduler(max_concurrency=workers, base_delay=latency / 2, max_delay=latency * 4)
+    session = SummarizerSession(client, scheduler=scheduler, max_workers=workers)
+
+    start = time.perf_counter()
+    failures = 0
+    chunks = 0
+    for _ in range(docs):
+        calls_before = client.calls
+        retries_before = scheduler.retries
+        try:
+            _, timings = sm.summarize_file(path, session)
+        except Exception:
+            failures += 1
+            continue
+        # Every request that wasn't a retry or a reduce step summarized one chunk
+        sent = client.calls - calls_before - (scheduler.retries - retries_before)
+        chunks += sent - sum(t["outputs"] for t in timings)
+    seconds = time.perf_counter() - start
+    session.close()
+
+    # ru_maxrss is in KiB on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    peak_mb = peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+    return {
+        "seconds": seconds,
+        "docs_per_min": (docs - failures) / seconds * 60,
+        "chunks_per_s": chunks / seconds,
+        "requests": client.calls,
+        "failures": failures,
+        "retries": scheduler.retries,
+        "peak_rss_mb": peak_mb,
+    }
+
+
+# Commands whose startup time is measured by --startup: importing the pipeline, and a --help run
+STARTUP_COMMANDS = {
+    "import summarizer": [sys.executable, "-c", "import summarizer"],
+    "batch.py --help": [sys.executable, "batch.py", "--help"],
+}
+
+
+def startup_benchmark(runs, max_ms=None):
+    # Median wall time of each command in a fresh interpreter. Returns False if any is over max_ms,
+    # so heavy imports creeping back in at module level show up as a failing run
+    here = os.path.dirname(os.path.abspath(__file__))
+    ok = True
+    for name, command in STARTUP_COMMANDS.items():
+        times = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            subprocess.run(command, cwd=here, check=True, stdout=subprocess.DEVNULL)
+            times.append((time.perf_counter() - start) * 1000)
+        median = statistics.median(times)
+        over = max_ms is not None and median > max_ms
+        ok = ok and not over
+        print(f"{name:>20}: {median:7.1f} ms median of {runs}{'  (over budget)' if over else ''}")
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the summarizer against a fake LLM backend")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[20000, 100000, 500000], help="document sizes in words")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 4, 16], help="MAX_WORKERS settings to try")
+    parser.add_argument("--docs", type=int, default=1, help="documents summarized per configuration")
+    parser.add_argument("--latency", type=float, default=0.2, help="fake seconds per request")
+    parser.add_argument("--jitter", type=float, default=0.05, help="random +/- seconds added to each request")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="chance a request fails with a server error")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="chance a request fails with a rate limit")
+    parser.add_argument("--startup", action="store_true", help="measure CLI startup time instead of throughput")
+    parser.add_argument("--runs", type=int, default=10, help="runs per command with --startup")
+    parser.add_argument("--max-startup-ms", type=float, help="with --startup, exit with an error if a median is above this")
+    args = parser.parse_args()
+
+    if args.startup:
+        sys.exit(0 if startup_benchmark(args.runs, args.max_startup_ms) else 1)
+
+    print(f"{'words':>8} {'workers':>7} {'seconds':>8} {'docs/min':>9} {'chunks/s':>9} {'requests':>8} {'retries':>7} {'failed':>6} {'peak MB':>8}")
+    with tempfile.TemporaryDirectory() as folder:
+        for size in args.sizes:
+            path = make_document(folder, size)
+            for workers in args.workers:
+                # A fresh process per configuration keeps peak RSS from carrying over between runs
+                with ProcessPoolExecutor(max_workers=1) as pool:
+                    r = pool.submit(run_one, path, workers, args.latency, args.jitter, args.error_rate,
+                                    args.rate_limit_rate, args.docs).result()
+                print(f"{size:>8} {workers:>7} {r['seconds']:>8.2f} {r['docs_per_min']:>9.1f} {r['chunks_per_s']:>9.1f} "
+                      f"{r['requests']:>8} {r['retries']:>7} {r['failures']:>6} {r['peak_rss_mb']:>8.1f}")
+
+
+if __name__ == "__main__":
+    main()
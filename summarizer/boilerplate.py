@@ -0,0 +1,107 @@
+## Removes running headers, footers, page numbers and copyright lines that repeat on every pdf page
+import itertools
+import re
+from collections import Counter
+
+import aid_funct as af
+
+
+# A line that is only a number, maybe with dashes or brackets around it ("12", "- 12 -", "[12]")
+PAGE_NUMBER = re.compile(r"^\W*(\d+)\W*$")
+
+
+def normalize_line(line):
+    # Page numbers and dates change from page to page, so digits are ignored when comparing lines
+    line = re.sub(r"\d+", "#", line.strip().lower())
+    return re.sub(r"\s+", " ", line)
+
+
+class BoilerplateFilter:
+    """
+    Streaming filter over pdf pages that drops lines repeated across pages.
+
+    The first `sample_pages` pages are read ahead; a line with letters in it
+    counts as boilerplate if (ignoring digits, case and spacing) it is among
+    the first or last `edge_lines` lines (at most a quarter of the page) of at
+    least `min_ratio` of those pages. Matching edge lines are then removed from
+    every page. Bare numbers are never boilerplate this way: the first or last
+    line is only dropped as a page number if, on enough pages, it is a number
+    that goes up with the page (page index plus a fixed offset).
+    `removed_lines` and `removed_tokens` count what was cut.
+    """
+
+    def __init__(self, model, min_ratio=0.5, sample_pages=50, edge_lines=4, min_pages=3):
+        self.model = model
+        self.min_ratio = min_ratio
+        self.sample_pages = sample_pages
+        self.edge_lines = edge_lines
+        self.min_pages = min_pages
+        self.boilerplate = set()
+        # Offset between the page number and the page index, for the first and last line (None = no page numbers there)
+        self.page_numbers = {"first": None, "last": None}
+        self.removed_lines = 0
+        self.removed_tokens = 0
+
+    def _edges(self, lines):
+        # Indexes of the non-empty lines at the top and bottom of a page. At most a quarter of
+        # a page counts as each edge, so short pages don't have their body text treated as edges
+        filled = [i for i, line in enumerate(lines) if line.strip()]
+        k = max(1, min(self.edge_lines, len(filled) // 4))
+        return set(filled[:k] + filled[-k:])
+
+    @staticmethod
+    def _ends(lines):
+        # Indexes of the first and last non-empty lines of a page
+        filled = [i for i, line in enumerate(lines) if line.strip()]
+        return {"first": filled[0], "last": filled[-1]} if filled else {}
+
+    def learn(self, pages):
+        # Counts each edge line once per page and keeps the ones with letters on enough pages.
+        # Numbers alone (years, section numbers, figures) vary too little to tell apart, so they
+        # only count as page numbers if they follow the page index
+        counts = Counter()
+        offsets = {"first": Counter(), "last": Counter()}
+        for index, page in enumerate(pages):
+            lines = page.split("\n")
+            counts.update({normalize_line(lines[i]) for i in self._edges(lines)})
+            for end, i in self._ends(lines).items():
+                match = PAGE_NUMBER.match(lines[i])
+                if match:
+                    offsets[end][int(match.group(1)) - index] += 1
+        needed = max(self.min_pages, self.min_ratio * len(pages))
+        self.boilerplate = {line for line, n in counts.items() if n >= needed and re.search(r"[a-z]", line)}
+        for end, counter in offsets.items():
+            offset, n = counter.most_common(1)[0] if counter else (None, 0)
+            self.page_numbers[end] = offset if n >= needed else None
+
+    def strip(self, page, index):
+        lines = page.split("\n")
+        edges = self._edges(lines)
+        # Lines that are this page's number
+        numbers = set()
+        for end, i in self._ends(lines).items():
+            match = PAGE_NUMBER.match(lines[i])
+            if match and self.page_numbers[end] is not None and int(match.group(1)) == index + self.page_numbers[end]:
+                numbers.add(i)
+        kept = []
+        enc = af.get_encoder(self.model)
+        for i, line in enumerate(lines):
+            if i in numbers or (i in edges and normalize_line(line) in self.boilerplate):
+                self.removed_lines += 1
+                self.removed_tokens += len(enc.encode(line))
+            else:
+                kept.append(line)
+        return "\n".join(kept)
+
+    def filter(self, pages):
+        # Reads ahead 'sample_pages' pages to learn the boilerplate, then yields every page without it
+        pages = iter(pages)
+        sample = []
+        for page in pages:
+            sample.append(page)
+            if len(sample) >= self.sample_pages:
+                break
+        self.learn(sample)
+
+        for index, page in enumerate(itertools.chain(sample, pages)):
+            yield self.strip(page, index)
@@ -0,0 +1,91 @@
+## Persistent cache for LLM responses so reruns don't pay for the same request twice
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+class SummaryCache:
+    """
+    Content-addressed cache of LLM outputs stored in a single SQLite file.
+
+    Entries are keyed on a hash of everything that changes the answer
+    (model, system prompt, task prompt, input text and max_output_tokens).
+    Once the stored text goes over `max_bytes`, the least recently used
+    entries are evicted. `hits` and `misses` count lookups for this process.
+    """
+
+    def __init__(self, path, max_bytes=256 * 1024 * 1024):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+        # One connection shared by the worker threads, guarded by a lock
+        self._lock = threading.Lock()
+        folder = os.path.dirname(path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, "
+            "size INTEGER NOT NULL, last_used REAL NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS by_use ON entries (last_used)")
+        self._db.commit()
+        self._size = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+
+    @staticmethod
+    def key(model, sys_prompt, task_prompt, text, max_output_tokens):
+        # json keeps the fields separate so ("ab", "c") and ("a", "bc") never collide
+        raw = json.dumps([model, sys_prompt, task_prompt, text, max_output_tokens])
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        with self._lock:
+            row = self._db.execute("SELECT value FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            # Bump the entry so it is the last to be evicted
+            self._db.execute("UPDATE entries SET last_used = ? WHERE key = ?", (time.time(), key))
+            self._db.commit()
+            return row[0]
+
+    def put(self, key, value):
+        size = len(value.encode("utf-8"))
+        with self._lock:
+            old = self._db.execute("SELECT size FROM entries WHERE key = ?", (key,)).fetchone()
+            if old is not None:
+                self._size -= old[0]
+            self._db.execute(
+                "INSERT OR REPLACE INTO entries (key, value, size, last_used) VALUES (?, ?, ?, ?)",
+                (key, value, size, time.time()),
+            )
+            self._size += size
+            self._evict()
+            self._db.commit()
+
+    def _evict(self):
+        # Drop least recently used entries until the cache fits in max_bytes again
+        while self._size > self.max_bytes:
+            row = self._db.execute(
+                "SELECT key, size FROM entries ORDER BY last_used LIMIT 1"
+            ).fetchone()
+            if row is None:
+                break
+            self._db.execute("DELETE FROM entries WHERE key = ?", (row[0],))
+            self._size -= row[1]
+
+    def stats(self):
+        with self._lock:
+            entries = self._db.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+        return {"hits": self.hits, "misses": self.misses, "entries": entries, "bytes": self._size}
+
+    def close(self):
+        with self._lock:
+            self._db.close()
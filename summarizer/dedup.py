@@ -0,0 +1,77 @@
+## Finds chunks that are (nearly) the same text so each is only sent to the LLM once
+import random
+import re
+import zlib
+
+# Mersenne prime used for the MinHash permutations
+_PRIME = (1 << 61) - 1
+
+
+def shingles(text, k=5):
+    # Set of hashed k-word windows of the text, ignoring case and punctuation
+    words = re.findall(r"\w+", text.lower())
+    if len(words) <= k:
+        return {zlib.crc32(" ".join(words).encode("utf-8"))}
+    return {zlib.crc32(" ".join(words[i:i + k]).encode("utf-8")) for i in range(len(words) - k + 1)}
+
+
+class ChunkDeduper:
+    """
+    Streaming near-duplicate detector for chunks, using MinHash signatures
+    over word shingles and LSH banding to find candidates.
+
+    `add(text)` returns the index (among the unique chunks) of the first
+    chunk the text is a near duplicate of, meaning an estimated Jaccard
+    similarity >= `threshold`, or None if it is new. Near duplicates are
+    dropped, not summarized: the chunk they repeat is summarized once and
+    the reduce step only needs each distinct summary once.
+    """
+
+    def __init__(self, threshold=0.9, num_perm=64, shingle_words=5, seed=1):
+        self.threshold = threshold
+        self.shingle_words = shingle_words
+        rng = random.Random(seed)
+        self._perms = [(rng.randrange(1, _PRIME), rng.randrange(0, _PRIME)) for _ in range(num_perm)]
+
+        # Pick bands x rows = num_perm so the LSH "S-curve" starts a bit below the threshold,
+        # so chunks at the threshold are almost always compared
+        self.rows = min((r for r in range(1, num_perm + 1) if num_perm % r == 0),
+                        key=lambda r: abs((r / num_perm) ** (1 / r) - threshold * 0.9))
+        self.bands = num_perm // self.rows
+        self._buckets = [{} for _ in range(self.bands)]
+
+        self.signatures = []
+        self.chunks = 0
+
+    def signature(self, text):
+        hashes = shingles(text, self.shingle_words)
+        return [min((a * h + b) % _PRIME for h in hashes) for a, b in self._perms]
+
+    def add(self, text):
+        self.chunks += 1
+        sig = self.signature(text)
+        keys = [tuple(sig[i * self.rows:(i + 1) * self.rows]) for i in range(self.bands)]
+
+        # Candidates share at least one band; check them in the order they were first seen
+        candidates = sorted({c for band, key in zip(self._buckets, keys) for c in band.get(key, ())})
+        for c in candidates:
+            other = self.signatures[c]
+            similarity = sum(x == y for x, y in zip(sig, other)) / len(sig)
+            if similarity >= self.threshold:
+                return c
+
+        index = len(self.signatures)
+        self.signatures.append(sig)
+        for band, key in zip(self._buckets, keys):
+            band.setdefault(key, []).append(index)
+        return None
+
+    def unique(self, chunks):
+        # Passes through only the chunks that aren't near duplicates of an earlier one
+        for c in chunks:
+            if self.add(c) is None:
+                yield c
+
+    def stats(self):
+        return {"chunks": self.chunks, "unique": len(self.signatures),
+                "calls_saved": self.chunks - len(self.signatures)}
@@ -0,0 +1,81 @@
+## Offline stand-in for the OpenAI client, used for benchmarks and dry runs without an API key
+import random
+import threading
+import time
+from collections import namedtuple
+
+FakeUsage = namedtuple("FakeUsage", ["input_tokens", "output_tokens"])
+FakeResponse = namedtuple("FakeResponse", ["output_text", "usage"])
+FakeEvent = namedtuple("FakeEvent", ["type", "delta", "response"])
+
+
+class FakeAPIError(Exception):
+    # Looks like a transient server error to the scheduler
+    status_code = 503
+
+
+class FakeRateLimitError(FakeAPIError):
+    status_code = 429
+
+
+class FakeClient:
+    """
+    Client with the same `client.responses.create(...)` call the summarizer
+    makes on the OpenAI client, but answered locally.
+
+    Each request waits `latency` seconds plus or minus up to `jitter`, fails
+    with FakeAPIError with probability `error_rate` (FakeRateLimitError with
+    probability `rate_limit_rate`), and otherwise returns a made-up bullet
+    list about as long as `max_output_tokens` allows. Every word of the answer
+    adds `token_delay` seconds. With stream=True the words are yielded as
+    `response.output_text.delta` events, the first one after `latency`, like
+    the OpenAI streaming API. `calls` counts every request made.
+    """
+
+    def __init__(self, latency=0.5, jitter=0.1, error_rate=0.0, rate_limit_rate=0.0, token_delay=0.0, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.token_delay = token_delay
+        self.calls = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.responses = self
+
+    def create(self, model, input, max_output_tokens=None, stream=False, **kwargs):
+        with self._lock:
+            self.calls += 1
+            delay = max(0.0, self.latency + self._random.uniform(-self.jitter, self.jitter))
+            roll = self._random.random()
+        time.sleep(delay)
+        if roll < self.rate_limit_rate:
+            raise FakeRateLimitError("fake rate limit")
+        if roll < self.rate_limit_rate + self.error_rate:
+            raise FakeAPIError("fake backend error")
+
+        # Build the answer out of words from the prompt so different inputs give different outputs
+        text = input[-1]["content"][0]["text"]
+        words = text.split()
+        n_words = min(len(words), (max_output_tokens or 500) // 2)
+        step = max(1, len(words) // max(1, n_words))
+        picked = words[::step][:n_words]
+        bullets = [" ".join(picked[i:i + 12]) for i in range(0, len(picked), 12)]
+        output_text = "\n".join(f"- {b}" for b in bullets)
+
+        # Rough token counts (about 3/4 of a word per token) in the same shape as the OpenAI usage object
+        usage = FakeUsage(input_tokens=int(len(words) * 4 / 3), output_tokens=int(len(picked) * 4 / 3))
+        response = FakeResponse(output_text, usage)
+        if stream:
+            return self._stream(response)
+        time.sleep(self.token_delay * len(picked))
+        return response
+
+    def _stream(self, response):
+        # One delta per word (keeping the whitespace after it), then a completed event
+        pieces = response.output_text.split(" ")
+        for i, piece in enumerate(pieces):
+            if i > 0:
+                time.sleep(self.token_delay)
+            yield FakeEvent("response.output_text.delta", piece if i == len(pieces) - 1 else piece + " ", None)
+        yield FakeEvent("response.completed", None, response)
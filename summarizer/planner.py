@@ -0,0 +1,129 @@
+## Picks chunk size, overlap and reduce fan-in for a document from the model's context window and the prompt sizes
+import math
+import os
+from collections import namedtuple
+
+import aid_funct as af
+
+# Context windows (tokens) of the models the summarizer is used with; other models get DEFAULT_CONTEXT
+CONTEXT_WINDOWS = {
+    "gpt-3.5-turbo": 16385,
+    "gpt-4-turbo": 128000,
+    "gpt-4o": 128000,
+    "gpt-4o-mini": 128000,
+    "gpt-4.1": 1047576,
+    "gpt-4.1-mini": 1047576,
+    "gpt-4.1-nano": 1047576,
+}
+DEFAULT_CONTEXT = 16385
+# Role markers and the "---" line around the prompt and text of every request
+REQUEST_OVERHEAD = 16
+# The "---" separator between summaries in a merge or synthesis request
+SEPARATOR_TOKENS = 5
+
+Plan = namedtuple("Plan", ["doc_tokens", "chunk_size", "overlap", "fan_in", "token_budget",
+                           "chunks", "merges", "requests", "input_tokens"])
+
+
+def estimate_tokens(file, model, first_page=0, last_page=None, sample_pages=3, sample_bytes=1 << 16):
+    # Rough token count of a document without reading all of it: the first few pages of a pdf
+    # (or the first 'sample_bytes' of a txt file) are tokenized and scaled up to the whole file
+    enc = af.get_encoder(model)
+    if af.file_kind(file) == "pdf":
+        import PyPDF2 as pdfr
+        with open(file, "rb") as f:
+            total = len(pdfr.PdfReader(f).pages)
+        stop = total if last_page is None else min(last_page, total)
+        sample = list(af.pdf_pages(file, first_page, min(first_page + sample_pages, stop)))
+        if not sample:
+            return 0
+        return sum(len(enc.encode(page)) for page in sample) * (stop - first_page) // len(sample)
+
+    size = os.path.getsize(file)
+    with open(file, "rb") as f:
+        head = f.read(sample_bytes)
+    if not head:
+        return 0
+    return len(enc.encode(head.decode("utf-8", errors="ignore"))) * size // len(head)
+
+
+def plan_chunks(doc_tokens, model, sys_prompt, task_prompt, merge_prompt, synth_prompt, chunk_output=500,
+                synth_output=1000, chunk_size=None, overlap=None, fan_in=None, max_chunk_tokens=None,
+                token_budget=None, min_chunk_tokens=1024, overlap_ratio=0.05, content_defined=False, slack=0.1,
+                context_window=None):
+    # Plans a run over a document of about 'doc_tokens' tokens with as few requests as possible.
+    # Chunks are as large as the context window (and 'max_chunk_tokens') allow after the prompts and
+    # the output cap, and the text is spread evenly over them so there is no small leftover chunk
+    # (but they are at least 'min_chunk_tokens').
+    # 'slack' pads the estimate so a slightly longer document doesn't spill into one more chunk.
+    # Overlap is 'overlap_ratio' of the chunk (none for a single chunk or content-defined chunks).
+    # The reduce budget is what fits in a merge or synthesis request (at most 'token_budget'), and the
+    # fan-in is how many full-length summaries fit in it. 'chunk_size', 'overlap' and 'fan_in' can be
+    # given to keep fixed settings and only estimate the requests they lead to
+    enc = af.get_encoder(model)
+    context = context_window or CONTEXT_WINDOWS.get(model, DEFAULT_CONTEXT)
+    base_tokens = len(enc.encode(sys_prompt)) + REQUEST_OVERHEAD
+    task_tokens = len(enc.encode(task_prompt))
+    merge_tokens = len(enc.encode(merge_prompt))
+    synth_tokens = len(enc.encode(synth_prompt))
+
+    room = context - base_tokens - task_tokens - chunk_output
+    if max_chunk_tokens is not None:
+        room = min(room, max_chunk_tokens)
+    if content_defined:
+        # Content-defined chunks can be up to 1.5 times the chunk size
+        room = room * 2 // 3
+    budget = context - base_tokens - max(merge_tokens + chunk_output, synth_tokens + synth_output)
+    if token_budget is not None:
+        budget = min(budget, token_budget)
+    if room <= 0 or budget <= 0:
+        raise ValueError(f"The prompts and output caps leave no room for text in the {context}-token context of {model}")
+
+    padded = max(1, math.ceil(doc_tokens * (1 + slack)))
+    if chunk_size is None:
+        n = math.ceil(padded / room)
+        while True:
+            step = math.ceil(padded / n)
+            planned_overlap = 0 if n == 1 or content_defined else round(step * overlap_ratio)
+            if step + planned_overlap <= room:
+                break
+            n += 1
+        # Never plan tiny chunks: a pdf whose first pages are scans can look almost empty
+        chunk_size = max(step + planned_overlap, min(room, min_chunk_tokens))
+        if content_defined:
+            # Rounded up to a step of a fixed ladder (quarter powers of two) so small edits that change
+            # the document length don't change the chunk size, which would move every chunk boundary
+            # and miss the cache. Rounded down instead if that doesn't fit
+            k = math.ceil(4 * math.log2(chunk_size / 1024))
+            chunk_size = round(1024 * 2 ** (k / 4))
+            if chunk_size > room:
+                chunk_size = round(1024 * 2 ** ((k - 1) / 4))
+        if overlap is None:
+            overlap = planned_overlap
+    if overlap is None or content_defined:
+        overlap = 0 if content_defined else round(chunk_size * overlap_ratio)
+    chunks = max(1, math.ceil((doc_tokens - overlap) / (chunk_size - overlap)))
+
+    summary_tokens = chunk_output + SEPARATOR_TOKENS
+    if fan_in is None:
+        fan_in = max(2, budget // summary_tokens)
+
+    # Merge requests per level until the summaries fit in one synthesis request
+    merges = 0
+    input_tokens = chunks * (base_tokens + task_tokens) + doc_tokens + (chunks - 1) * overlap
+    remaining = chunks
+    while remaining > 1 and (remaining > fan_in or remaining * summary_tokens > budget):
+        level = math.ceil(remaining / min(fan_in, max(2, budget // summary_tokens)))
+        merges += level
+        input_tokens += level * (base_tokens + merge_tokens) + remaining * summary_tokens
+        remaining = level
+    input_tokens += base_tokens + synth_tokens + remaining * summary_tokens
+
+    return Plan(doc_tokens, chunk_size, overlap, fan_in, budget, chunks, merges, chunks + merges + 1, input_tokens)
+
+
+def format_plan(plan):
+    return (f"Plan: ~{plan.doc_tokens} tokens -> {plan.chunks} chunk(s) of {plan.chunk_size} tokens "
+            f"({plan.overlap} overlap), reduce fan-in {plan.fan_in} within {plan.token_budget} tokens\n"
+            f"      about {plan.requests} requests ({plan.chunks} chunk, {plan.merges} merge, 1 synthesis), "
+            f"~{plan.input_tokens} input tokens")
@@ -0,0 +1,123 @@
+## Keeps LLM requests flowing at the highest rate the API allows: retries, backoff and adaptive concurrency
+import math
+import random
+import threading
+import time
+
+
+def is_rate_limit(error):
+    return getattr(error, "status_code", None) == 429 or type(error).__name__ == "RateLimitError"
+
+
+def is_retryable(error):
+    # Rate limits, timeouts, dropped connections and server errors usually go away if you wait
+    status = getattr(error, "status_code", None)
+    if is_rate_limit(error) or status in (408, 409) or (status is not None and status >= 500):
+        return True
+    return type(error).__name__ in ("APIConnectionError", "APITimeoutError", "InternalServerError")
+
+
+def retry_after(error):
+    # Seconds the server asked us to wait, if it said
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+class RequestScheduler:
+    """
+    Runs LLM calls with retries, exponential backoff with jitter, a
+    tokens-per-minute budget and AIMD concurrency.
+
+    The number of requests allowed in flight starts at `max_concurrency`, is
+    halved on every rate-limit error (never below `min_concurrency`) and grows
+    back by about one request per round of successes. Before each request,
+    its estimated tokens are taken from a bucket that refills at
+    `tokens_per_minute` (None = no budget). Share one scheduler between all
+    documents of a run so they all see the same limits.
+    """
+
+    def __init__(self, max_concurrency=8, min_concurrency=1, tokens_per_minute=None,
+                 max_retries=6, base_delay=1.0, max_delay=60.0):
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.tokens_per_minute = tokens_per_minute
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+        self.limit = float(max_concurrency)
+        self.in_flight = 0
+        self.retries = 0
+        self.rate_limited = 0
+        self._slots = threading.Condition()
+
+        self._tokens = float(tokens_per_minute or 0)
+        self._refilled = time.monotonic()
+        self._budget = threading.Lock()
+
+    def _acquire_slot(self):
+        with self._slots:
+            while self.in_flight >= math.floor(self.limit):
+                self._slots.wait()
+            self.in_flight += 1
+
+    def _release_slot(self, rate_limited=False):
+        with self._slots:
+            self.in_flight -= 1
+            if rate_limited:
+                # Multiplicative decrease
+                self.limit = max(self.min_concurrency, self.limit / 2)
+            else:
+                # Additive increase: about +1 after a full window of successes
+                self.limit = min(self.max_concurrency, self.limit + 1 / self.limit)
+            self._slots.notify_all()
+
+    def _take_tokens(self, tokens):
+        # Token bucket holding up to one minute of budget. A request bigger than the whole bucket waits for a full bucket
+        if not self.tokens_per_minute:
+            return
+        tokens = min(tokens, self.tokens_per_minute)
+        rate = self.tokens_per_minute / 60
+        with self._budget:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.tokens_per_minute, self._tokens + (now - self._refilled) * rate)
+                self._refilled = now
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                time.sleep((tokens - self._tokens) / rate)
+
+    def backoff(self, attempt, error=None):
+        # Full jitter: a random wait up to base * 2^attempt, unless the server said how long to wait
+        wait = retry_after(error) if error is not None else None
+        if wait is None:
+            wait = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        return wait
+
+    def call(self, fn, tokens=0):
+        # Runs fn() and returns (result, number of retries it took). Errors that aren't worth retrying,
+        # or that are still failing after max_retries retries, are raised
+        attempt = 0
+        while True:
+            self._take_tokens(tokens)
+            self._acquire_slot()
+            try:
+                result = fn()
+            except Exception as e:
+                limited = is_rate_limit(e)
+                self._release_slot(rate_limited=limited)
+                if not is_retryable(e) or attempt >= self.max_retries:
+                    raise
+                with self._slots:
+                    self.retries += 1
+                    self.rate_limited += limited
+                time.sleep(self.backoff(attempt, e))
+                attempt += 1
+                continue
+            self._release_slot()
+            return result, attempt
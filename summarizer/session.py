@@ -0,0 +1,71 @@
+## One long-lived object holding everything the LLM calls share: client, connection pool, cache, scheduler and threads
+from concurrent.futures import ThreadPoolExecutor
+
+import aid_funct as af
+
+
+class SummarizerSession:
+    """
+    Shared state for every request of a run, across chunks, syntheses and
+    documents.
+
+    Unless a `client` is given, the session builds an OpenAI client on its own
+    pooled HTTP client. That pool keeps up to `max_keepalive` connections
+    alive for `keepalive_expiry` seconds, so requests reuse open TLS
+    connections instead of doing a new handshake each time. It applies
+    `connect_timeout` and `request_timeout` to every request. The session
+    also owns the request thread pool (`max_workers` threads), the cache and
+    the scheduler. Use it as a context manager, or call `close()`, to shut
+    the pool and connections down.
+    """
+
+    def __init__(self, client=None, cache=None, scheduler=None, max_workers=4, max_connections=None,
+                 max_keepalive=None, keepalive_expiry=30.0, connect_timeout=10.0, request_timeout=120.0):
+        self.cache = cache
+        self.scheduler = scheduler
+        self.max_workers = max_workers
+        self._http = None
+
+        if client is None:
+            import httpx
+            # Enough connections for every worker thread, with a few spare for streamed responses
+            limits = httpx.Limits(
+                max_connections=max_connections or max_workers + 4,
+                max_keepalive_connections=max_keepalive or max_workers,
+                keepalive_expiry=keepalive_expiry,
+            )
+            timeout = httpx.Timeout(request_timeout, connect=connect_timeout)
+            self._http = httpx.Client(limits=limits, timeout=timeout)
+            # The scheduler retries with backoff, so the SDK only retries on its own when there isn't one
+            client = af.make_client("openai", http_client=self._http, timeout=timeout,
+                                    max_retries=0 if scheduler is not None else 2)
+        self.client = client
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def summarize_chunk(self, model, sys_prompt, task_prompt, chunk_text, **kwargs):
+        return af.summarize_chunk(self.client, model, sys_prompt, task_prompt, chunk_text,
+                                  cache=self.cache, scheduler=self.scheduler, **kwargs)
+
+    def synthesize(self, model, sys_prompt, synth_prompt, synth_input, **kwargs):
+        return af.synthesize(self.client, model, sys_prompt, synth_prompt, synth_input,
+                             cache=self.cache, scheduler=self.scheduler, **kwargs)
+
+    def summarize_chunks(self, model, sys_prompt, task_prompt, chunks, **kwargs):
+        return af.summarize_chunks(self.client, model, sys_prompt, task_prompt, chunks, max_workers=self.max_workers,
+                                   cache=self.cache, executor=self.executor, scheduler=self.scheduler, **kwargs)
+
+    def tree_synthesize(self, model, sys_prompt, merge_prompt, synth_prompt, summaries, **kwargs):
+        return af.tree_synthesize(self.client, model, sys_prompt, merge_prompt, synth_prompt, summaries,
+                                  max_workers=self.max_workers, cache=self.cache, executor=self.executor,
+                                  scheduler=self.scheduler, **kwargs)
+
+    def close(self):
+        self.executor.shutdown()
+        if self._http is not None:
+            self._http.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -1,42 +1,193 @@
 ## Goal is to create a program that sends a pdf to an LLM and gets back a summary
-import aid_funct as af
-
-
-## Prompting user for a pdf file
-file = input("Enter the name of the pdf or txt file (include '.pdf'): ")
-print("Summarizing: ", file, " ...")
+import os
+import time
 
-## Read in the pdf or txt file
-text = ""
-if ".pdf" in file:
-    # Read pdf and conver to text
-    text = af.pdf_reader(file, "text.txt")
-elif ".txt" in file:
-    with open(file, "r") as f:
-        text = f.read()
-        f.close()
-else:
-    print("Please enter a pdf or txt file")
-    exit()
-
-# Clean text
-text = af.text_cleaner(text)
+import aid_funct as af
+import planner
+from boilerplate import BoilerplateFilter
+from cache import SummaryCache
+from dedup import ChunkDeduper
+from scheduler import RequestScheduler
+from session import SummarizerSession
+from tracing import Tracer
 
-# Split the text into chunks
-chunks = af.chunk(text, chunk_size=4000, overlap=200, model="gpt-4o-mini")
+MODEL = "gpt-4o-mini"
+# "fixed": 4000-token windows with 200 tokens of overlap. "content": content-defined chunks (about
+# 4000 tokens, no overlap) whose boundaries follow the text, so after an edit only the changed
+# chunks miss the cache and get summarized again
+CHUNKING = "fixed"
+CHUNK_SIZE = 4000
+CHUNK_OVERLAP = 200
+# Work out chunk size, overlap and reduce fan-in for each document from its length and the model's
+# context window (see planner.py) instead of using CHUNK_SIZE, CHUNK_OVERLAP and REDUCE_FAN_IN.
+# Planned chunks are at most MAX_CHUNK_TOKENS (None = as large as the context window allows)
+PLAN_CHUNKS = True
+MAX_CHUNK_TOKENS = 16000
+# Max number of chunk summaries requested from the LLM at the same time
+MAX_WORKERS = 4
+# Where chunk summaries and syntheses are cached between runs
+CACHE_PATH = ".summary_cache.sqlite"
+# Processes used to extract pdf text (1 = no process pool) and which pages to read (0-based, end excluded; None = to the end)
+EXTRACT_WORKERS = 1
+FIRST_PAGE = 0
+LAST_PAGE = None
+# Tree reduce: max summaries merged per request and max tokens of summaries sent in one request
+# (with PLAN_CHUNKS, the fan-in is planned and the token budget is an upper limit)
+REDUCE_FAN_IN = 16
+REDUCE_TOKEN_BUDGET = 12000
+# Token budget per minute for the account's rate limit (None = no budget); on rate limits the
+# scheduler backs off and lowers concurrency below MAX_WORKERS, then grows it back
+TOKENS_PER_MINUTE = 200000
+MAX_RETRIES = 6
+# Lines at the top/bottom of at least this fraction of pdf pages (headers, footers, page numbers) are
+# removed before chunking (None = keep them). The first BOILERPLATE_SAMPLE_PAGES pages are read
+# before the first chunk goes out, to learn which lines repeat
+BOILERPLATE_MIN_RATIO = 0.5
+BOILERPLATE_SAMPLE_PAGES = 50
+# Chunks at least this similar (estimated Jaccard over 5-word shingles) to an earlier chunk reuse
+# its summary instead of being sent to the LLM (None = send every chunk)
+DEDUP_THRESHOLD = 0.9
+# Print the final summary token by token as it is generated instead of all at once at the end
+STREAM_OUTPUT = True
+# Each run writes an NDJSON trace of stage times, request latencies and token counts here
+TRACE_DIR = "traces"
 
 # System, user, and synthesis prompts
 sys_prompt = "You are a precise, faithful scientific summarizer. You avoid speculation and clearly label you limitations."
 task_prompt = "Summarize the following text for a college‑level audience. Constraints: Max 6 bullet points, each ≤ 25 words. Include 2–4 key findings, 1–2 caveats. Mention important numbers, dates, or definitions exactly as written. If a term is introduced, define it once succinctly. Return only Markdown bullet points."
+merge_prompt = "you are merging several chunk summaries from consecutive parts of the same document into one shorter summary. Return at most 8 Markdown bullet points, each ≤ 30 words. Keep important numbers, dates, and definitions exactly as written. Do not invent facts and only use what appears in the chunk summaries."
 synth_prompt = "you are merging multiple chunk summaries from the same document. produce a cohesive summary of about 250 - 300 words with: 5-7 bullet points under 'Main takeaways', and a 'List of Key Terms' bullet list that includes the key terms and their definitions (this list can be sort of long). Do not invent facts and only use what appears in chunk summaries."
 
-# Summarize each chunk with LLM
-mini_summaries = []
-for c in chunks:
-    mini_summaries.append(af.summarize_chunk(af.client, "gpt-4o-mini", sys_prompt, task_prompt, c))
 
-# Send mini summaries to LLM for synthesis
-synth_input = "\n\n---\n\n".join(mini_summaries)
-final_output = af.synthesize(af.client, "gpt-4o-mini", sys_prompt, synth_prompt, synth_input)
+def read_pages(file):
+    # Read in the pdf or txt file page by page
+    kind = af.file_kind(file)
+    if kind == "pdf":
+        return af.pdf_pages(file, FIRST_PAGE, LAST_PAGE, workers=EXTRACT_WORKERS)
+    elif kind == "txt":
+        return af.txt_pages(file)
+    raise ValueError(f"{file} is not a pdf or txt file")
+
+
+def make_session(client=None, cache=None, max_workers=MAX_WORKERS, tokens_per_minute=TOKENS_PER_MINUTE):
+    # A session with the pooled OpenAI client (unless 'client' is given) and a scheduler for the account's limits
+    scheduler = RequestScheduler(max_concurrency=max_workers, tokens_per_minute=tokens_per_minute, max_retries=MAX_RETRIES)
+    return SummarizerSession(client, cache, scheduler, max_workers=max_workers)
+
+
+def plan_for(file):
+    # Chunk and reduce settings for 'file', with the number of requests and tokens they should take.
+    # Without PLAN_CHUNKS the fixed settings are kept and only the estimates are worked out
+    doc_tokens = planner.estimate_tokens(file, MODEL, FIRST_PAGE, LAST_PAGE)
+    fixed = {} if PLAN_CHUNKS else {"chunk_size": CHUNK_SIZE, "overlap": CHUNK_OVERLAP, "fan_in": REDUCE_FAN_IN}
+    return planner.plan_chunks(doc_tokens, MODEL, sys_prompt, task_prompt, merge_prompt, synth_prompt,
+                               max_chunk_tokens=MAX_CHUNK_TOKENS, token_budget=REDUCE_TOKEN_BUDGET,
+                               content_defined=CHUNKING == "content", **fixed)
+
+
+def summarize_file(file, session, tracer=None, on_token=None, plan=None):
+    # Runs one document through the whole pipeline and returns the summary and the reduce timings.
+    # The 'session' (see session.py) holds the client, cache, scheduler and request threads, and can
+    # be shared between documents (see batch.py). Pass a 'tracer' to record stage times and every
+    # request, and 'on_token' to stream the final summary. The chunk and reduce settings come from
+    # 'plan' (see plan_for), which is made here if it isn't given
+    stages = tracer if tracer is not None else Tracer()
+    if plan is None:
+        with stages.stage("plan"):
+            plan = plan_for(file)
+    stages.event("plan", **plan._asdict())
+
+    # Extract, clean and split into chunks as the pages come in. These stages pull from each other,
+    # so each one's time is only the time spent in that stage itself
+    pages = stages.timed("extract", read_pages(file))
+    boilerplate = None
+    # Only pdfs have real pages: txt files are read in fixed-size windows, so the "edge" lines of a
+    # window are wherever it was cut and repeated lines there (like "Speaker 1:") are body text
+    if BOILERPLATE_MIN_RATIO is not None and af.file_kind(file) == "pdf":
+        boilerplate = BoilerplateFilter(MODEL, BOILERPLATE_MIN_RATIO, BOILERPLATE_SAMPLE_PAGES)
+        pages = stages.timed("boilerplate", boilerplate.filter(pages))
+    text = stages.timed("clean", af.clean_stream(pages))
+    if CHUNKING == "content":
+        chunks = af.cdc_chunk_stream(text, chunk_size=plan.chunk_size, model=MODEL)
+    else:
+        chunks = af.chunk_stream(text, chunk_size=plan.chunk_size, overlap=plan.overlap, model=MODEL)
+    chunks = stages.timed("chunk", chunks)
+
+    # Drop repeated boilerplate, appendices, etc. before they cost an LLM call
+    deduper = None
+    if DEDUP_THRESHOLD is not None:
+        deduper = ChunkDeduper(DEDUP_THRESHOLD)
+        chunks = stages.timed("dedup", deduper.unique(chunks))
+
+    # Summarize the chunks with LLM, several at a time, starting before the whole file is read (results stay in chunk order).
+    # The map time is wall time, so it includes the extract/clean/chunk time above
+    with stages.stage("map"):
+        mini_summaries = session.summarize_chunks(MODEL, sys_prompt, task_prompt, chunks, tracer=tracer)
+    if boilerplate is not None:
+        stages.count("boilerplate_lines", boilerplate.removed_lines)
+        stages.count("boilerplate_tokens", boilerplate.removed_tokens)
+    if deduper is not None:
+        # Near duplicates were dropped before the map step: the chunk they repeat was summarized
+        # once, and the reduce step only needs each distinct summary once
+        stats = deduper.stats()
+        stages.count("chunks", stats["chunks"])
+        stages.count("duplicate_chunks", stats["calls_saved"])
+
+    # Merge the mini summaries level by level until they fit in one synthesis request, then synthesize
+    with stages.stage("reduce"):
+        final_output, timings = session.tree_synthesize(MODEL, sys_prompt, merge_prompt, synth_prompt, mini_summaries,
+                                                        fan_in=plan.fan_in, token_budget=plan.token_budget,
+                                                        tracer=tracer, on_token=on_token)
+    for t in timings:
+        stages.event("reduce_level", **t)
+    return final_output, timings
+
+
+def print_trace_summary(summary):
+    for name, stage in summary["stages"].items():
+        print(f"{name:>8}: {stage['seconds']:.2f}s")
+    print(f"Requests: {summary['requests']} ({summary['cached']} cached, {summary['retries']} retries, {summary['errors']} errors), "
+          f"p50 {summary['p50_seconds']:.2f}s, p95 {summary['p95_seconds']:.2f}s")
+    if summary["first_token_seconds"] is not None:
+        print(f"Time to first token (streamed): {summary['first_token_seconds']:.2f}s")
+    print(f"Tokens sent: {summary['input_tokens']} in, {summary['output_tokens']} out")
+    counters = summary["counters"]
+    if counters.get("boilerplate_lines"):
+        print(f"Boilerplate removed: {counters['boilerplate_lines']} lines, {counters['boilerplate_tokens']} tokens")
+    if "duplicate_chunks" in counters:
+        print(f"Near-duplicate chunks: {counters['duplicate_chunks']} of {counters['chunks']} (LLM calls saved)")
+
+
+def main():
+    ## Prompting user for a pdf file
+    file = input("Enter the name of the pdf or txt file (include '.pdf'): ")
+    if af.file_kind(file) is None:
+        print("Please enter a pdf or txt file")
+        exit()
+    print("Summarizing: ", file, " ...")
+
+    cache = SummaryCache(CACHE_PATH)
+    name = os.path.splitext(os.path.basename(file))[0]
+    tracer = Tracer(os.path.join(TRACE_DIR, f"{time.strftime('%Y%m%d-%H%M%S')}_{name}.ndjson"), doc=file)
+    on_token = (lambda t: print(t, end="", flush=True)) if STREAM_OUTPUT else None
+    plan = plan_for(file)
+    print(planner.format_plan(plan))
+    with make_session(cache=cache) as session:
+        final_output, timings = summarize_file(file, session, tracer=tracer, on_token=on_token, plan=plan)
+
+    if not STREAM_OUTPUT:
+        print(final_output)
+    print("\n")
+    for t in timings:
+        print(f"Reduce level {t['level']}: {t['inputs']} summaries -> {t['outputs']} in {t['seconds']:.1f}s")
+    stats = cache.stats()
+    print(f"Cache: {stats['hits']} hits, {stats['misses']} misses")
+    cache.close()
+
+    summary = tracer.close()
+    print_trace_summary(summary)
+    print(f"Trace written to {tracer.path}")
+
 
-print(final_output)
\ No newline at end of file
+if __name__ == "__main__":
+    main()
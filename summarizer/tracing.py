@@ -0,0 +1,154 @@
+## Records where time and tokens go in a summarizer run and writes it out as an NDJSON trace
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+
+class Tracer:
+    """
+    Collects per-stage wall time and per-request latency, token counts and
+    retries for one run.
+
+    Request records are appended to `path` (one JSON object per line) as they
+    happen, so a crashed run still leaves a trace; stage totals and a summary
+    line are written by `close()`. `for_doc()` gives a tracer for one document
+    that writes into the same file, for batch runs; its records also count
+    towards the run's totals.
+    """
+
+    def __init__(self, path=None, _file=None, _lock=None, _parent=None, **labels):
+        self.path = path
+        self.labels = labels
+        self._parent = _parent
+        self.requests = []
+        self.stages = {}
+        self.counters = {}
+        self._lock = _lock or threading.Lock()
+        self._owns_file = _file is None and path is not None
+        self._file = _file
+        if self._owns_file:
+            folder = os.path.dirname(path)
+            if folder:
+                os.makedirs(folder, exist_ok=True)
+            self._file = open(path, "w")
+        # Per thread stack of time spent in nested timed generators (see timed)
+        self._local = threading.local()
+
+    def for_doc(self, doc):
+        return Tracer(self.path, _file=self._file, _lock=self._lock, _parent=self, **self.labels, doc=doc)
+
+    def _write(self, record):
+        if self._file is not None:
+            self._file.write(json.dumps({**self.labels, **record}) + "\n")
+            self._file.flush()
+
+    def _add_stage(self, name, seconds, items=0):
+        with self._lock:
+            tracer = self
+            while tracer is not None:
+                stage = tracer.stages.setdefault(name, {"seconds": 0.0, "items": 0})
+                stage["seconds"] += seconds
+                stage["items"] += items
+                tracer = tracer._parent
+
+    def count(self, name, n=1):
+        # Run-wide counters (e.g. LLM calls saved by deduplication)
+        with self._lock:
+            tracer = self
+            while tracer is not None:
+                tracer.counters[name] = tracer.counters.get(name, 0) + n
+                tracer = tracer._parent
+
+    @contextmanager
+    def stage(self, name):
+        # Wall time of a block of code
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._add_stage(name, time.perf_counter() - start)
+
+    def timed(self, name, iterable):
+        # Wraps a generator stage (extract, clean, chunk) and adds up the time spent producing its items.
+        # Stages pull from each other, so time spent in an inner timed stage is only counted there
+        it = iter(iterable)
+        while True:
+            stack = self._local.__dict__.setdefault("stack", [])
+            stack.append(0.0)
+            start = time.perf_counter()
+            try:
+                item = next(it)
+                done = False
+            except StopIteration:
+                done = True
+            elapsed = time.perf_counter() - start
+            inner = stack.pop()
+            if stack:
+                stack[-1] += elapsed
+            self._add_stage(name, elapsed - inner, 0 if done else 1)
+            if done:
+                return
+            yield item
+
+    def record_request(self, kind, seconds, input_tokens, output_tokens, retries=0, cached=False, error=None, **extra):
+        record = {
+            "type": "request",
+            "kind": kind,
+            "seconds": seconds,
+            "input_tokens": input_tokens,
+            "output_tokens": output_tokens,
+            "retries": retries,
+            "cached": cached,
+            "error": error,
+            **extra,
+        }
+        with self._lock:
+            tracer = self
+            while tracer is not None:
+                tracer.requests.append(record)
+                tracer = tracer._parent
+            self._write(record)
+
+    def event(self, name, **fields):
+        # Any other record worth keeping in the trace (e.g. the timing of each reduce level)
+        with self._lock:
+            self._write({"type": name, **fields})
+
+    def summary(self):
+        # Totals for the run plus the slowest requests, to find bad chunks and tune chunk_size/overlap
+        sent = [r for r in self.requests if not r["cached"]]
+        latencies = sorted(r["seconds"] for r in sent)
+        first_tokens = [r["first_token_seconds"] for r in sent if "first_token_seconds" in r]
+
+        def percentile(p):
+            return latencies[min(len(latencies) - 1, int(p * len(latencies)))] if latencies else 0.0
+
+        return {
+            "stages": self.stages,
+            "counters": self.counters,
+            "requests": len(self.requests),
+            "cached": len(self.requests) - len(sent),
+            "retries": sum(r["retries"] for r in self.requests),
+            "errors": sum(1 for r in self.requests if r["error"]),
+            "input_tokens": sum(r["input_tokens"] for r in sent),
+            "output_tokens": sum(r["output_tokens"] for r in sent),
+            "p50_seconds": percentile(0.5),
+            "p95_seconds": percentile(0.95),
+            # Time to first token of streamed requests
+            "first_token_seconds": sum(first_tokens) / len(first_tokens) if first_tokens else None,
+            "slowest": sorted(sent, key=lambda r: r["seconds"], reverse=True)[:5],
+        }
+
+    def close(self):
+        # Writes the stage totals and summary; the file is closed by the tracer that opened it
+        with self._lock:
+            for name, stage in self.stages.items():
+                self._write({"type": "stage", "name": name, **stage})
+        summary = self.summary()
+        with self._lock:
+            self._write({"type": "summary", **{k: v for k, v in summary.items() if k not in ("stages", "slowest")}})
+            if self._owns_file:
+                self._file.close()
+        return summary